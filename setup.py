@@ -34,4 +34,8 @@ setup(
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=['atomicwrites'],
+    extras_require={
+        'blake3': ['blake3'],
+        'test': ['pytest', 'pytest-xdist'],
+    },
 )
@@ -1,5 +1,6 @@
 from .keeper import Keeper
 from .storage.writecachestorage import WriteCacheStorage
+from .storage.indexedstorage import IndexedStorage
 from .storage.filestorage import FileStorage
 
 from .version import __version__, __version_info__
@@ -8,4 +9,5 @@ __all__ = [
     "Keeper",
     "FileStorage",
     "WriteCacheStorage",
+    "IndexedStorage",
 ]
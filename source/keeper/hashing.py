@@ -0,0 +1,43 @@
+import hashlib
+
+# The fastest digest in the standard library, on CPUs with or without the SHA
+# extensions. Keys identify content rather than protect it.
+DEFAULT_DIGEST = "sha1"
+
+
+def digest_factory(name):
+    """Obtain a callable which creates new digester objects.
+
+    Args:
+        name: The name of a hashlib algorithm, such as "sha1" (the default),
+            "sha256" (which OpenSSL accelerates with SHA-NI where available) or
+            "blake2b", or "blake3", which requires the optional blake3 package.
+
+    Returns:
+        A callable taking no arguments which returns a new digester with
+        update() and hexdigest() methods.
+
+    Raises:
+        ValueError: If the named digest is not available.
+    """
+    if name == "blake3":
+        try:
+            from blake3 import blake3
+        except ImportError:
+            raise ValueError("The blake3 digest requires the blake3 package") from None
+        # BLAKE3 is a tree hash, so large updates can be spread over all cores
+        return blake3(max_threads=blake3.AUTO).copy
+
+    try:
+        # Keys identify content rather than protect it, so the digest is not
+        # used for security. This also keeps SHA-1 available where OpenSSL
+        # runs in FIPS mode. hashlib.new uses OpenSSL's implementations, which
+        # are accelerated with SHA-NI where the CPU supports it.
+        digester = hashlib.new(name, usedforsecurity=False)
+    except (TypeError, ValueError):
+        raise ValueError(f"Unsupported digest {name!r}") from None
+    if digester.digest_size == 0:
+        # Extendable-output functions such as shake_128 have no fixed length
+        raise ValueError(f"Unsupported digest {name!r}")
+    # Copying a pristine digester is cheaper than constructing a new one
+    return digester.copy
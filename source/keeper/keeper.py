@@ -1,11 +1,24 @@
+import itertools
+import shutil
 import threading
-from collections import Mapping
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures.thread import ThreadPoolExecutor
 import logging
 
+from keeper.hashing import DEFAULT_DIGEST, digest_factory
 from keeper.streams import WriteableBinaryStream
-from keeper.values import Value
+from keeper.values import DEFAULT_ENCODING, Value, ValueMeta, read_meta
 
-DEFAULT_ENCODING = "utf-8"
+# Strings longer than this many characters are encoded incrementally by add()
+ENCODE_CHUNK_LENGTH = 1024 * 1024
+
+# The number of metadata reads scan_meta() has in flight at once
+SCAN_META_WORKERS = 16
+SCAN_META_BATCH_SIZE = 1024
+
+# The number of values for which each Keeper holds metadata in memory
+META_CACHE_SIZE = 4096
 
 logger = logging.getLogger(__name__)
 
@@ -18,25 +31,56 @@ class KeeperClosed(ValueError):
 
 class Keeper(Mapping):
 
-    def __init__(self, storage):
-        self._lock = threading.RLock()
+    def __init__(self, storage, digest=DEFAULT_DIGEST):
+        """
+        Args:
+            storage: The Storage in which values will be kept.
+
+            digest: The name of the digest algorithm used to compute keys from
+                values and their metadata. Defaults to "sha1", the fastest
+                digest in the standard library. Alternatives include "sha256",
+                which has no known collision attacks, and "blake3" (requires
+                the blake3 package), which hashes large values on all cores.
+                Keys computed with different digests differ, so a store should
+                always be used with the same digest if identical values are
+                to be shared. Keys never match those computed by keeper 1.1.1
+                and earlier, whatever the digest, because the metadata is
+                serialised differently.
+
+        Raises:
+            ValueError: If the digest is not available.
+        """
+        self._lock = threading.Lock()
         self._storage = storage
+        self._digest = digest
+        self._new_digester = digest_factory(digest)
+        # Every key is a hexdigest, so keys of any other length can be rejected at once
+        self._key_length = len(self._new_digester().hexdigest())
+        self._meta_cache_lock = threading.Lock()
+        self._meta_cache = OrderedDict()
+
+    @property
+    def digest(self):
+        """The name of the digest algorithm used to compute keys."""
+        return self._digest
 
     @property
     def storage(self):
-        if self.closed:
+        # Reading a single attribute is atomic, so no lock is needed on this hot path
+        storage = self._storage
+        if storage is None:
             raise KeeperClosed()
-        with self._lock:
-            return self._storage
+        return storage
 
     @property
     def closed(self):
-        with self._lock:
-            return self._storage is None
+        return self._storage is None
 
     def close(self):
         with self._lock:
             self._storage = None
+        with self._meta_cache_lock:
+            self._meta_cache.clear()
         logger.debug("%s closing", type(self).__name__)
 
     def __enter__(self):
@@ -54,7 +98,8 @@ class Keeper(Mapping):
 
         encoding: If encoding is None (the default) the returned file-like-
             object will only accept bytes objects. If the encoding is not None
-            only strings will be accepted.
+            strings will also be accepted, and are encoded as they are
+            written.
 
         **meta: Meta data about the stream which will be stored along with the
             stream.
@@ -79,45 +124,167 @@ class Keeper(Mapping):
         Returns:
             A key for the data
         """
-        logger.debug(
-            "%s adding data of length %r with MIME type %r and encoding %r",
-            type(self).__name__,
-            len(data),
-            mime,
-            encoding
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            # Avoid evaluating the arguments when not logging, as add() is called often
+            logger.debug(
+                "%s adding data of length %r with MIME type %r and encoding %r",
+                type(self).__name__,
+                len(data),
+                mime,
+                encoding
+            )
 
         if isinstance(data, str):
             encoding = encoding or DEFAULT_ENCODING
-            data = data.encode(encoding)
-
-        if not isinstance(data, bytes):
+            if len(data) <= ENCODE_CHUNK_LENGTH:
+                return self._add_bytes(data.encode(encoding), mime, encoding, meta)
+        elif isinstance(data, bytes):
+            return self._add_bytes(data, mime, encoding, meta)
+        else:
             raise TypeError("data type must be bytes or str")
 
-        with self.add_stream(mime, encoding=encoding, **meta) as stream:
-            stream.write(data)
-        return stream.key
+        # Large strings are written a slice at a time, which the stream encodes
+        # incrementally, so an encoded copy of the whole string is never held in memory
+        stream = self.add_stream(mime, encoding=encoding, **meta)
+        try:
+            for start in range(0, len(data), ENCODE_CHUNK_LENGTH):
+                stream.write(data[start:start + ENCODE_CHUNK_LENGTH])
+        except BaseException:
+            # Don't commit a partially encoded value
+            stream._discard()
+            raise
+        return stream.close()
+
+    def _add_bytes(self, data, mime, encoding, meta):
+        # Bytes already in memory can be hashed before anything is written, so
+        # adding a duplicate costs no I/O and a new value needs no temporary.
+        value_meta = ValueMeta(length=len(data), mime=mime, encoding=encoding, **meta)
+        serialised_meta = value_meta.serialise()
+        digester = self._new_digester()
+        digester.update(data)
+        digester.update(serialised_meta)
+        key = digester.hexdigest()
+        storage = self.storage
+        # Membership is always decided by the storage, never the metadata
+        # cache, which cannot see removals made by other keepers or processes
+        if not storage.has_meta(key):
+            storage.write_data(key, data)
+            storage.write_meta(key, serialised_meta)
+        self._cache_meta(key, value_meta)
+        return key
+
+    def copy_from(self, other, key):
+        """Copy a value from another Keeper, without hashing it again.
+
+        Keys are computed from content, so a key from a Keeper using the same
+        digest identifies the same value here. Its data and metadata are copied
+        exactly as stored.
+
+        Args:
+            other: The Keeper from which to copy.
+            key: The key of the value in other.
+
+        Returns:
+            The key, which is the same in both keepers.
+
+        Raises:
+            ValueError: If other uses a different digest.
+            KeyError: If other has no value with key.
+        """
+        if other.digest != self.digest:
+            raise ValueError(
+                f"Cannot copy between keepers using digests {other.digest!r} and {self.digest!r}"
+            )
+        if key in self:
+            return key
+        source = other.storage
+        with source.openin_meta(key) as meta_file:
+            serialised_meta = meta_file.read()
+        storage = self.storage
+        with source.openin_data(key) as data_file, storage.openout_data(key) as out:
+            shutil.copyfileobj(data_file, out)
+        storage.write_meta(key, serialised_meta)
+        return key
 
     def __contains__(self, key):
-        logging.debug("%s checking for membership of key %r", type(self).__name__, key)
-        try:
-            with self.storage.openin_meta(key):
-                contained = True
-        except KeyError:
-            contained = False
-        logging.debug(
-            "%s %s key %r",
-            type(self).__name__,
-            "contains" if contained else "does not contain",
-            key
-        )
+        if not self._is_possible_key(key):
+            return False
+        contained = self.storage.has_meta(key)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "%s %s key %r",
+                type(self).__name__,
+                "contains" if contained else "does not contain",
+                key
+            )
         return contained
 
+    def contains_many(self, keys):
+        """Determine the membership of many keys at once.
+
+        This is preferable to testing each key in turn, for example when
+        comparing the contents of two keepers, because the storage can check
+        the keys in bulk.
+
+        Args:
+            keys: An iterable of keys.
+
+        Returns:
+            A dictionary mapping each key to True if it is present in this
+            keeper, otherwise False.
+        """
+        keys = list(keys)
+        stored = self.storage.has_meta_many([key for key in keys if self._is_possible_key(key)])
+        return {key: key in stored for key in keys}
+
     def __iter__(self):
         """Obtain an iterator over all keys
+
+        A store is used with a single digest. Keys added to the same store
+        with another digest are included, but cannot be retrieved through
+        this keeper.
         """
         yield from self.storage.keys()
 
+    def scan_meta(self, keys=None):
+        """Iterate over the metadata of many values.
+
+        The metadata is read by a pool of threads, so that many small reads
+        can be in flight at once. This is considerably faster than looking up
+        each key in turn when the metadata is not already cached by the
+        operating system.
+
+        Args:
+            keys: An iterable of keys. If None (the default) all keys are
+                scanned.
+
+        Yields:
+            (key, ValueMeta) pairs in the order of keys. Keys which are not
+            present are skipped.
+        """
+        storage = self.storage
+        if keys is None:
+            keys = iter(self)
+        else:
+            # Malformed keys are skipped here, as read_meta() would raise
+            # something other than KeyError for them
+            keys = filter(self._is_possible_key, keys)
+
+        def read(key):
+            try:
+                return key, read_meta(storage, key)
+            except KeyError:
+                return key, None
+
+        with ThreadPoolExecutor(max_workers=SCAN_META_WORKERS) as executor:
+            while True:
+                batch = list(itertools.islice(keys, SCAN_META_BATCH_SIZE))
+                if not batch:
+                    break
+                for key, meta in executor.map(read, batch):
+                    if meta is not None:
+                        yield key, meta
+
     def __getitem__(self, key):
         """Retrieve data by its key.
 
@@ -133,8 +300,10 @@ class Keeper(Mapping):
         logger.debug("%s getting item with key %r", type(self).__name__, key)
         if self.closed:
             raise KeeperClosed()
+        if not self._is_possible_key(key):
+            raise KeyError(key)
         try:
-            return Value(self, key)
+            return Value(self, key, self._read_meta(key))
         except KeyError:
             logger.debug("%s has not item with key %r", type(self).__name__, key)
             raise
@@ -143,12 +312,45 @@ class Keeper(Mapping):
         """Remove an item by its key"""
         logger.debug("%s removing item with key %r", type(self).__name__, key)
         if key in self:
-            return self.storage.discard(key)
+            self.storage.discard(key)
+            with self._meta_cache_lock:
+                self._meta_cache.pop(key, None)
+            return
         raise KeyError(key)
 
+    def _is_possible_key(self, key):
+        return isinstance(key, str) and len(key) == self._key_length
+
+    def _read_meta(self, key):
+        # Values are immutable, so their metadata can be cached. The value may
+        # have been removed by another keeper or process, though, so the
+        # storage is asked whether it is still present, which costs much less
+        # than reading and deserialising the metadata again.
+        storage = self.storage
+        with self._meta_cache_lock:
+            meta = self._meta_cache.get(key)
+            if meta is not None:
+                self._meta_cache.move_to_end(key)
+        if meta is not None:
+            if storage.has_meta(key):
+                return meta
+            with self._meta_cache_lock:
+                self._meta_cache.pop(key, None)
+            raise KeyError(key)
+        meta = read_meta(storage, key)
+        self._cache_meta(key, meta)
+        return meta
+
+    def _cache_meta(self, key, meta):
+        with self._meta_cache_lock:
+            self._meta_cache[key] = meta
+            self._meta_cache.move_to_end(key)
+            if len(self._meta_cache) > META_CACHE_SIZE:
+                self._meta_cache.popitem(last=False)
+
     def __len__(self):
-        return sum(1 for _ in self)
+        return self.storage.count()
 
     def __repr__(self):
-        return f"{type(self).__name__}(storage={self._storage})"
+        return f"{type(self).__name__}(storage={self._storage}, digest={self._digest!r})"
 
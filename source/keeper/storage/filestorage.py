@@ -1,18 +1,32 @@
 import contextlib
+import errno
+import functools
+import io
+import itertools
 import logging
 import os
 import shutil
-import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import atomicwrites
-from atomicwrites import replace_atomic
 
 from keeper.storage.storage import Storage
 from keeper.storage.streams import WriteOnlyStream, ReadOnlyStream
 
 META_EXTENSION = '.pickle'
 
+# Within a batch, pending metadata is flushed once this many entries accumulate
+META_BATCH_SIZE = 1024
+
+# Files are synced one at a time, so this many are synced at once. The threads
+# spend their time waiting on the device rather than the CPU.
+SYNC_WORKERS = min(64, (os.cpu_count() or 1) * 8)
+
+# The most copy_file_range() is asked to copy in one call
+COPY_CHUNK_SIZE = 1 << 30
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,7 +38,12 @@ class FileStorage(Storage):
             root_dirpath: The path to a directory in which data will be stored. If dirpath does
                 not exist it will be created.
 
-            levels: The number of levels of key to split into directories.
+            levels: The number of levels of key to split into directories,
+                one character per level. Defaults to 4, giving up to 16^4
+                directories for hexadecimal keys. Fewer levels, such as 2,
+                give a shallower tree which is quicker to enumerate, at the
+                cost of more files per directory. A store must always be
+                opened with the same number of levels.
 
         Raises:
             FileExistsError: If parts of the structure within dirpath already exist, but
@@ -49,76 +68,140 @@ class FileStorage(Storage):
         self._meta_root_path = self._root_dirpath / 'meta'
         self._data_root_path = self._root_dirpath / 'data'
 
-        shutil.rmtree(self._temp_root_path, ignore_errors=True)
+        # Path prefixes as strings, so per-key paths can be built with one concatenation
+        self._meta_root_prefix = str(self._meta_root_path) + os.sep
+        self._data_root_prefix = str(self._data_root_path) + os.sep
+
+        # Metadata written within a batch, by key, which is not yet on disk
+        self._pending_meta_lock = threading.Lock()
+        self._pending_meta = {}
+        # Data files written within a batch, which are not yet durable
+        self._unsynced_data_paths = []
+        # Directories from which files were removed within a batch
+        self._unsynced_dirpaths = set()
+        # Batches are per thread, so writes made by other threads outside a
+        # batch are still durable when they return
+        self._batch_state = threading.local()
+        self._flush_lock = threading.Lock()
+
+        # Directories known to exist. FileStorage never removes them, so each
+        # need only be created once, rather than on every write.
+        self._known_dirpaths = set()
+
+        self._clear_temp_directory()
 
-        self._temp_root_path.mkdir(parents=True, exist_ok=True)
         self._meta_root_path.mkdir(parents=True, exist_ok=True)
         self._data_root_path.mkdir(parents=True, exist_ok=True)
 
+    def _clear_temp_directory(self):
+        # Temporaries left behind by a failed process are removed. After a
+        # clean shutdown there are none, so the directory is kept, rather than
+        # removed and created again.
+        try:
+            with os.scandir(self._temp_root_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.unlink(entry.path)
+        except (FileNotFoundError, NotADirectoryError):
+            # Raises FileExistsError if there is a file in the way
+            self._temp_root_path.mkdir(parents=True, exist_ok=True)
+
     @property
     def root_path(self):
         return self._root_dirpath
 
-    def _relative_key_path(self, key):
-        if len(key) < self._levels:
-            raise ValueError("Key is too short")
-
-        path_components = list(key[:self._levels])
-        path_components.append(key[self._levels:])
-        return Path(*path_components)
+    def _relative_key_path(self, key) -> str:
+        return _relative_key_path(key, self._levels)
 
     def keys(self):
-        for dirpath, dirnames, filenames in os.walk(self._meta_root_path):
-            prefix_dirpath = dirpath[len(str(self._meta_root_path)):]
-            prefix = ''.join(prefix_dirpath.split(os.sep))
-            for filename in filenames:
-                suffix = filename[:-len(META_EXTENSION)]
-                key = prefix + suffix
-                yield key
+        with self._pending_meta_lock:
+            pending_keys = set(self._pending_meta)
+        if not pending_keys:
+            yield from self._keys_below(self._meta_root_prefix, "")
+            return
+        yield from pending_keys
+        yield from itertools.filterfalse(
+            pending_keys.__contains__, self._keys_below(self._meta_root_prefix, "")
+        )
+
+    def _keys_below(self, dirpath, prefix):
+        # scandir reports entry types from the directory listing itself, avoiding a stat per entry
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._keys_below(entry.path, prefix + entry.name)
+                elif entry.name.endswith(META_EXTENSION):
+                    yield prefix + entry.name[:-len(META_EXTENSION)]
+
+    def count(self):
+        with self._pending_meta_lock:
+            pending_keys = list(self._pending_meta)
+        if not pending_keys:
+            return self._count_below(self._meta_root_prefix)
+        uncounted = sum(1 for key in pending_keys if not os.path.exists(self._meta_filepath(key)))
+        return self._count_below(self._meta_root_prefix) + uncounted
+
+    def _count_below(self, dirpath):
+        count = 0
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    count += self._count_below(entry.path)
+                elif entry.name.endswith(META_EXTENSION):
+                    count += 1
+        return count
 
     def _meta_path(self, key) -> Path:
-        return self._meta_root_path / self._relative_key_path(key).with_suffix(META_EXTENSION)
+        return Path(self._meta_filepath(key))
+
+    def _meta_filepath(self, key) -> str:
+        # Constructing a Path costs several times more than building the string
+        return self._meta_root_prefix + self._relative_key_path(key) + META_EXTENSION
 
     @contextlib.contextmanager
     def openout_temp(self):
-        handle = str(uuid.uuid4())
+        debug = logger.isEnabledFor(logging.DEBUG)
+        handle = _new_temp_name()
         temp_path = self._temp_path(handle)
-        logger.debug(
-            "%s creating temporary file %r",
-            type(self).__name__,
-            temp_path,
-        )
-        with open(temp_path, mode="wb") as temp_file:
+        if debug:
             logger.debug(
-                "%s opened temporary file with path %r",
+                "%s creating temporary file %r",
                 type(self).__name__,
-                temp_file.name
+                temp_path,
             )
-            with WriteOnlyStream(temp_file, name=handle) as stream:
-                yield stream
-            if not temp_file.closed:
-                temp_file.flush()
+        # Exclusive creation, so a clashing name fails rather than truncating another writer's file
+        with open(temp_path, mode="xb") as temp_file:
+            if debug:
                 logger.debug(
-                    "%s fsynced temporary file with path %r",
+                    "%s opened temporary file with path %r",
                     type(self).__name__,
                     temp_file.name
                 )
-                atomicwrites._proper_fsync(temp_file.fileno())
-        logger.debug(
-            "%s closed temporary file with path %r",
-            type(self).__name__,
-            temp_file.name
-        )
-        self._sync_parent_directory(temp_path)
+            with WriteOnlyStream(temp_file, name=handle) as stream:
+                yield stream
+        # Temporaries are not made durable here, as they are deleted on
+        # startup anyway. Those promoted are synced by promote_temp(), and
+        # those removed, such as duplicates, are never synced at all.
+        if debug:
+            logger.debug(
+                "%s closed temporary file with path %r",
+                type(self).__name__,
+                temp_file.name
+            )
 
     @contextlib.contextmanager
     def openin_temp(self, handle):
+        debug = logger.isEnabledFor(logging.DEBUG)
         temp_path = self._temp_path(handle)
-        logger.debug(
-            "%s opening temporary file %r for read",
-            type(self).__name__,
-            temp_path,
-        )
+        if debug:
+            logger.debug(
+                "%s opening temporary file %r for read",
+                type(self).__name__,
+                temp_path,
+            )
         try:
             with open(temp_path, mode="rb") as temp_file:
                 with ReadOnlyStream(temp_file, name=handle) as stream:
@@ -126,11 +209,12 @@ class FileStorage(Storage):
         except FileNotFoundError:
             raise KeyError(handle)
 
-        logger.debug(
-            "%s closed temporary file with path %r",
-            type(self).__name__,
-            temp_file.name
-        )
+        if debug:
+            logger.debug(
+                "%s closed temporary file with path %r",
+                type(self).__name__,
+                temp_file.name
+            )
 
     def _temp_path(self, handle):
         return self._temp_root_path / handle
@@ -145,25 +229,69 @@ class FileStorage(Storage):
         Raises:
             ValueError: If handle does not exist.
         """
-        logger.debug(
-            "%s promoting temporary file with name %s and key %r",
-            type(self).__name__,
-            handle,
-            key,
-        )
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(
+                "%s promoting temporary file with name %s and key %r",
+                type(self).__name__,
+                handle,
+                key,
+            )
         temp_path = self._temp_path(handle)
         data_path = self._data_path(key)
-        data_path.parent.mkdir(parents=True, exist_ok=True)
+        deferred = self._in_batch()
+        if not deferred:
+            try:
+                fd = os.open(temp_path, os.O_RDONLY)
+            except FileNotFoundError:
+                raise ValueError(handle)
+            try:
+                atomicwrites._proper_fsync(fd)
+            finally:
+                os.close(fd)
+        self._make_parent_directory(data_path)
         try:
-            replace_atomic(temp_path, data_path)
+            self._replace_from_temp(temp_path, data_path, sync=not deferred)
         except FileNotFoundError:
             raise ValueError(handle)
-        logger.debug(
-            "%s promoted temporary file %s to permanent by moving %s",
-            type(self).__name__,
-            temp_path,
-            data_path
-        )
+        if deferred:
+            with self._pending_meta_lock:
+                self._unsynced_data_paths.append(data_path)
+        else:
+            self._sync_parent_directory(data_path)
+        if debug:
+            logger.debug(
+                "%s promoted temporary file %s to permanent by moving %s",
+                type(self).__name__,
+                temp_path,
+                data_path
+            )
+
+    def _replace_from_temp(self, temp_path: Path, path: Path, sync=True):
+        # Temporaries usually live on the same filesystem as the data, so this
+        # is a rename, not a copy
+        try:
+            os.replace(temp_path, path)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            # Unless temp/ has been mounted from another filesystem, in which
+            # case a copy is made durable if the temporary would have been
+            self._copy_across_devices(temp_path, path, sync=sync)
+
+    def _copy_across_devices(self, temp_path: Path, data_path: Path, sync=True):
+        # The copy is made alongside its destination, so it can still be
+        # renamed into place atomically
+        staging_path = data_path.with_name(f"{data_path.name}.{_new_temp_name()}")
+        try:
+            _copy_file(temp_path, staging_path)
+            if sync:
+                _sync_file(staging_path)
+            os.replace(staging_path, data_path)
+        except BaseException:
+            staging_path.unlink(missing_ok=True)
+            raise
+        temp_path.unlink()
 
     def remove_temp(self, handle):
         temp_path = self._temp_path(handle)
@@ -185,66 +313,257 @@ class FileStorage(Storage):
     @contextlib.contextmanager
     def openout_meta(self, key):
         meta_filepath = self._meta_path(key)
-        meta_filepath.parent.mkdir(parents=True, exist_ok=True)
+        self._make_parent_directory(meta_filepath)
         with atomicwrites.atomic_write(meta_filepath, mode="wb", overwrite=True) as meta_file:
             with WriteOnlyStream(meta_file, name=key) as stream:
                 yield stream
 
-    @contextlib.contextmanager
+    def write_meta(self, key, data):
+        in_batch = self._in_batch()
+        with self._pending_meta_lock:
+            # Metadata must never become durable before its data, so while any
+            # data is unsynced, metadata goes through a flush even outside a batch
+            if in_batch or self._unsynced_data_paths:
+                self._pending_meta[key] = bytes(data)
+                full = not in_batch or len(self._pending_meta) >= META_BATCH_SIZE
+            else:
+                full = None
+        if full is None:
+            self._write_file(self._meta_path(key), data)
+        elif full:
+            self.flush()
+
     def openin_meta(self, key):
-        meta_filepath = self._meta_path(key)
+        with self._pending_meta_lock:
+            data = self._pending_meta.get(key)
+        if data is not None:
+            return io.BytesIO(data)
         try:
-            with open(meta_filepath, "rb") as meta_file:
-                with ReadOnlyStream(meta_file, name=key) as stream:
-                    yield stream
+            return open(self._meta_filepath(key), "rb")
         except FileNotFoundError:
             raise KeyError(key)
 
-    def _data_path(self, key) -> Path:
-        return self._data_root_path / self._relative_key_path(key)
+    def has_meta(self, key):
+        with self._pending_meta_lock:
+            if key in self._pending_meta:
+                return True
+        # A single stat, rather than opening and closing the file
+        return os.path.exists(self._meta_filepath(key))
+
+    def has_meta_many(self, keys):
+        # Iterated twice, so an iterator must not be consumed by the first pass
+        keys = list(keys)
+        with self._pending_meta_lock:
+            found = {key for key in keys if key in self._pending_meta}
+        # Group the remaining keys by directory, so that a directory holding
+        # several of them is listed once rather than each key being stat'ed
+        keys_by_dirpath = {}
+        for key in keys:
+            if key not in found:
+                dirpath, _, filename = self._meta_filepath(key).rpartition(os.sep)
+                keys_by_dirpath.setdefault(dirpath, {})[filename] = key
+        for dirpath, keys_by_filename in keys_by_dirpath.items():
+            if len(keys_by_filename) == 1:
+                (filename, key), = keys_by_filename.items()
+                if os.path.exists(dirpath + os.sep + filename):
+                    found.add(key)
+                continue
+            try:
+                filenames = os.listdir(dirpath)
+            except FileNotFoundError:
+                continue
+            found.update(keys_by_filename[name] for name in keys_by_filename.keys() & filenames)
+        return found
 
     @contextlib.contextmanager
-    def openout_data(self, key):
+    def batch(self):
+        """Group writes, so they are made durable together.
+
+        Within the context, metadata written with write_meta() is held in
+        memory, where it is visible to this FileStorage, and flushed to disk
+        in batches. Data written with write_data() is written at once, but
+        made durable by the same flush, before its metadata, as are removals
+        made with discard(). This replaces the four sequential fsyncs per
+        value made outside a batch with syncs of only this store's files,
+        issued concurrently at each flush. Values not yet flushed are lost if
+        the process fails. Batches may be nested, in which case the outermost
+        batch flushes on exit.
+
+        A batch applies only to the thread which entered it. Writes made by
+        other threads at the same time are made durable as usual.
+        """
+        state = self._batch_state
+        state.depth = getattr(state, "depth", 0) + 1
+        try:
+            yield self
+        finally:
+            state.depth -= 1
+            if state.depth == 0:
+                self.flush()
+
+    def _in_batch(self):
+        return getattr(self._batch_state, "depth", 0) > 0
+
+    def flush(self):
+        """Make any data written in a batch durable, then write any pending
+        metadata to disk and make it durable."""
+        with self._flush_lock:
+            self._flush_pending_meta()
+
+    def _flush_pending_meta(self):
+        with self._pending_meta_lock:
+            pending = dict(self._pending_meta)
+            unsynced_data_paths = list(self._unsynced_data_paths)
+            unsynced_dirpaths = set(self._unsynced_dirpaths)
+        if not pending and not unsynced_data_paths and not unsynced_dirpaths:
+            return
         logger.debug(
-            "%s opening write-only data file for key %r",
+            "%s flushing %d data and %d metadata files",
             type(self).__name__,
-            key,
+            len(unsynced_data_paths),
+            len(pending),
         )
+        # All data, and every metadata temporary, is made durable before any
+        # metadata is renamed into place, so a failure can never expose
+        # incomplete values.
+        renames = []
+        try:
+            for key, data in pending.items():
+                temp_path = self._temp_path(_new_temp_name())
+                with open(temp_path, "xb") as temp_file:
+                    temp_file.write(data)
+                renames.append((temp_path, self._meta_path(key)))
+            _sync_files([*unsynced_data_paths, *(temp_path for temp_path, _ in renames)])
+            _sync_directories(
+                unsynced_dirpaths | {data_path.parent for data_path in unsynced_data_paths}
+            )
+            with self._pending_meta_lock:
+                # Paths are only ever appended, so those synced are at the front
+                del self._unsynced_data_paths[:len(unsynced_data_paths)]
+                self._unsynced_dirpaths -= unsynced_dirpaths
+            for temp_path, meta_path in renames:
+                self._make_parent_directory(meta_path)
+                self._replace_from_temp(temp_path, meta_path)
+        except BaseException:
+            for temp_path, _ in renames:
+                temp_path.unlink(missing_ok=True)
+            raise
+        if renames:
+            _sync_directories({meta_path.parent for _, meta_path in renames})
+        with self._pending_meta_lock:
+            for key, data in pending.items():
+                if self._pending_meta.get(key) is data:
+                    del self._pending_meta[key]
+
+    def _data_path(self, key) -> Path:
+        return Path(self._data_filepath(key))
+
+    def _data_filepath(self, key) -> str:
+        return self._data_root_prefix + self._relative_key_path(key)
+
+    @contextlib.contextmanager
+    def openout_data(self, key):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(
+                "%s opening write-only data file for key %r",
+                type(self).__name__,
+                key,
+            )
         data_filepath = self._data_path(key)
-        data_filepath.parent.mkdir(parents=True, exist_ok=True)
+        self._make_parent_directory(data_filepath)
         with atomicwrites.atomic_write(data_filepath, mode="wb", overwrite=True) as datafile:
             yield datafile
 
-    @contextlib.contextmanager
+    def write_data(self, key, data):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(
+                "%s writing data file of length %d for key %r",
+                type(self).__name__,
+                len(data),
+                key,
+            )
+        deferred = self._in_batch()
+        self._write_file(self._data_path(key), data, sync=not deferred)
+        if deferred:
+            with self._pending_meta_lock:
+                self._unsynced_data_paths.append(self._data_path(key))
+
+    def _write_file(self, path: Path, data, sync=True):
+        # The data is already complete in memory, so bypass the file object layer
+        # and write it with as few system calls as possible. The temporary is
+        # written alongside other temporaries, so is cleared up after a crash.
+        self._make_parent_directory(path)
+        temp_path = self._temp_path(_new_temp_name())
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            if sync:
+                atomicwrites._proper_fsync(fd)
+        finally:
+            os.close(fd)
+        try:
+            self._replace_from_temp(temp_path, path, sync=sync)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        if sync:
+            self._sync_parent_directory(path)
+
     def openin_data(self, key):
-        logger.debug(
-            "%s opening read-only data file for key %r",
-            type(self).__name__,
-            key,
-        )
-        data_filepath = self._data_path(key)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(
+                "%s opening read-only data file for key %r",
+                type(self).__name__,
+                key,
+            )
         try:
-            with open(data_filepath, mode="rb") as datafile:
-                yield datafile
+            # Reads need only the path string, not a Path
+            return open(self._data_filepath(key), mode="rb")
         except FileNotFoundError:
             raise KeyError(key)
 
     def discard(self, key):
         logger.debug("%s removing key %r", type(self).__name__, key)
+        # Wait for any flush in progress, which could otherwise write the metadata back
+        with self._flush_lock, self._pending_meta_lock:
+            self._pending_meta.pop(key, None)
+        deferred = self._in_batch()
         meta_filepath = self._meta_path(key)
-        meta_filepath.unlink(missing_ok=True)
-        self._sync_parent_directory(meta_filepath)
+        self._unlink_and_sync(meta_filepath, sync=not deferred)
 
         data_filepath = self._data_path(key)
-        data_filepath.unlink(missing_ok=True)
-        self._sync_parent_directory(data_filepath)
+        self._unlink_and_sync(data_filepath, sync=not deferred)
         logger.debug("%s removed %r", type(self).__name__, data_filepath)
 
+    def _unlink_and_sync(self, path: Path, sync=True):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            # Metadata pending in a batch may never have had a directory created
+            return
+        if sync:
+            self._sync_parent_directory(path)
+        else:
+            with self._pending_meta_lock:
+                self._unsynced_dirpaths.add(path.parent)
+
+    def _make_parent_directory(self, path: Path):
+        dirpath = path.parent
+        if dirpath not in self._known_dirpaths:
+            dirpath.mkdir(parents=True, exist_ok=True)
+            self._known_dirpaths.add(dirpath)
+
     def _sync_parent_directory(self, path: Path):
         logger.debug("Syncing parent directory of %s", path)
         atomicwrites._sync_directory(path.parent)
 
     def close(self):
+        self.flush()
         self._root_dirpath = None
         logger.debug("%s closed", type(self).__name__)
 
@@ -258,3 +577,77 @@ class FileStorage(Storage):
 
     def __repr__(self):
         return f"{type(self).__name__}(root_dirpath={self.root_dirpath}, levels={self._levels})"
+
+
+# Temporary names need only be unique among the processes sharing a store, so
+# a counter replaces a UUID per name. Process ids alone are not enough, as
+# processes in separate PID namespaces, such as containers, can share a store
+# with the same id, so they are qualified by a random token for this module.
+_temp_counter = itertools.count()
+_temp_token = os.urandom(8).hex()
+
+
+def _new_temp_name():
+    return f"{os.getpid():x}-{_temp_token}-{next(_temp_counter)}"
+
+
+@functools.lru_cache(maxsize=16384)
+def _relative_key_path(key, levels):
+    # Keys are looked up repeatedly, so their relative paths are memoised
+    if len(key) < levels:
+        raise ValueError("Key is too short")
+    return os.sep.join((*key[:levels], key[levels:]))
+
+
+def _sync_files(paths):
+    # Only the files this store wrote are synced. A system-wide sync() would
+    # also wait on every other dirty file on the host.
+    _map_concurrently(_sync_file, paths)
+
+
+def _copy_file(source_path, destination_path):
+    # copy_file_range() copies within the kernel, and on filesystems such as
+    # btrfs and XFS can share the blocks rather than copy them
+    with open(source_path, "rb") as source, open(destination_path, "xb") as destination:
+        if hasattr(os, "copy_file_range"):
+            copied = 0
+            try:
+                while True:
+                    count = os.copy_file_range(source.fileno(), destination.fileno(), COPY_CHUNK_SIZE)
+                    if count == 0:
+                        return
+                    copied += count
+            except OSError:
+                # Not supported between these files, so fall back if nothing was copied
+                if copied:
+                    raise
+        shutil.copyfileobj(source, destination)
+
+
+def _sync_file(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        # Discarded since it was written
+        return
+    try:
+        atomicwrites._proper_fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _sync_directories(dirpaths):
+    _map_concurrently(atomicwrites._sync_directory, dirpaths)
+
+
+def _map_concurrently(function, items):
+    # The GIL is released during each sync, so the device can service them together
+    items = list(items)
+    if len(items) <= 1:
+        for item in items:
+            function(item)
+        return
+    with ThreadPoolExecutor(max_workers=min(SYNC_WORKERS, len(items))) as executor:
+        # Consume the results, so any exception is raised here
+        for _ in executor.map(function, items):
+            pass
@@ -0,0 +1,123 @@
+import contextlib
+import logging
+import threading
+
+from keeper.storage.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class IndexedStorage(Storage):
+    """A storage intermediary which keeps an in-memory index of keys.
+
+    Membership tests, counts and iteration over keys are answered from the
+    index without touching the underlying storage. The index is built from
+    the keys of the underlying storage when first needed, and is kept up to
+    date by writes and discards made through this object. Changes made to the
+    underlying storage by other means, such as by other processes, are not
+    seen.
+    """
+
+    def __init__(self, storage: Storage):
+        if storage.closed:
+            raise ValueError(f"Underlying storage is {storage} is closed")
+        self._storage = storage
+        self._index_lock = threading.Lock()
+        self._index = None
+
+    def close(self):
+        self._storage = None
+        self._index = None
+
+    @property
+    def closed(self):
+        return self._storage is None
+
+    @property
+    def storage(self):
+        if self.closed:
+            raise ValueError(f"Operation on closed storage {self}")
+        return self._storage
+
+    def _keys_index(self):
+        # Once built, the index is read and changed only while holding the
+        # lock, briefly, so this does not rely on the GIL
+        index = self._index
+        if index is None:
+            with self._index_lock:
+                if self._index is None:
+                    logger.debug("%s building index of %s", type(self).__name__, self._storage)
+                    self._index = set(self.storage.keys())
+                index = self._index
+        return index
+
+    def keys(self):
+        """An iterator over all keys."""
+        index = self._keys_index()
+        with self._index_lock:
+            keys = list(index)
+        yield from keys
+
+    def count(self):
+        index = self._keys_index()
+        with self._index_lock:
+            return len(index)
+
+    def has_meta(self, key):
+        index = self._keys_index()
+        with self._index_lock:
+            return key in index
+
+    def has_meta_many(self, keys):
+        keys = list(keys)
+        index = self._keys_index()
+        with self._index_lock:
+            return index.intersection(keys)
+
+    def openin_meta(self, key):
+        return self.storage.openin_meta(key)
+
+    @contextlib.contextmanager
+    def openout_meta(self, key):
+        with self.storage.openout_meta(key) as meta_file:
+            yield meta_file
+        self._add_to_index(key)
+
+    def write_meta(self, key, data):
+        self.storage.write_meta(key, data)
+        self._add_to_index(key)
+
+    def openin_data(self, key):
+        return self.storage.openin_data(key)
+
+    def openout_data(self, key):
+        return self.storage.openout_data(key)
+
+    def write_data(self, key, data):
+        self.storage.write_data(key, data)
+
+    def openin_temp(self, handle):
+        return self.storage.openin_temp(handle)
+
+    def openout_temp(self):
+        return self.storage.openout_temp()
+
+    def promote_temp(self, handle, key):
+        self.storage.promote_temp(handle, key)
+
+    def remove_temp(self, handle):
+        self.storage.remove_temp(handle)
+
+    def discard(self, key):
+        self.storage.discard(key)
+        index = self._keys_index()
+        with self._index_lock:
+            index.discard(key)
+
+    def _add_to_index(self, key):
+        index = self._keys_index()
+        with self._index_lock:
+            index.add(key)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(storage={self._storage})"
@@ -9,6 +9,14 @@ class Storage(ABC):
         """
         raise NotImplementedError
 
+    def count(self):
+        """The number of keys.
+
+        Subclasses should override this with something cheaper than iterating
+        over all keys.
+        """
+        return sum(1 for _ in self.keys())
+
     @abstractmethod
     def openout_meta(self, key):
         raise NotImplementedError
@@ -17,10 +25,51 @@ class Storage(ABC):
     def openin_meta(self, key):
         raise NotImplementedError
 
+    def write_meta(self, key, data):
+        """Store data, which is complete serialised metadata, for key.
+
+        Subclasses may override this with something cheaper than writing
+        through openout_meta().
+        """
+        with self.openout_meta(key) as meta_file:
+            meta_file.write(data)
+
+    def has_meta(self, key):
+        """Determine whether metadata is stored for key.
+
+        Subclasses should override this with something cheaper than opening
+        the metadata.
+        """
+        try:
+            with self.openin_meta(key):
+                return True
+        except KeyError:
+            return False
+
+    def has_meta_many(self, keys):
+        """Determine which of many keys have metadata stored.
+
+        Subclasses should override this with something cheaper than checking
+        each key in turn.
+
+        Returns:
+            The set of those keys which have metadata stored.
+        """
+        return {key for key in keys if self.has_meta(key)}
+
     @abstractmethod
     def openout_data(self, key):
         raise NotImplementedError
 
+    def write_data(self, key, data):
+        """Store data, which is the complete value, for key.
+
+        Subclasses may override this with something cheaper than writing
+        through openout_data().
+        """
+        with self.openout_data(key) as data_file:
+            data_file.write(data)
+
     def openin_data(self, key):
         raise NotImplementedError
 
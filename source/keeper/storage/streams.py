@@ -10,9 +10,15 @@ class WriteOnlyStream:
     def __init__(self, raw, name=None):
         self._raw = raw
         self._name = name
+        # Bind the methods used for every write directly, so each call is not
+        # routed through the _f property. They are unbound again on close().
+        self.write = raw.write
+        self.writelines = raw.writelines
 
     def close(self):
         self._raw = None
+        vars(self).pop("write", None)
+        vars(self).pop("writelines", None)
 
     def __enter__(self):
         return self
@@ -79,9 +85,6 @@ class WriteOnlyStream:
     def writelines(self, lines):
         return self._f.writelines(lines)
 
-    def __del__(self):
-        return self.close()
-
     @property
     def name(self):
         if self._name is not None:
@@ -102,6 +105,10 @@ class ReadOnlyStream:
     def __init__(self, raw, name=None):
         self._raw = raw
         self._name = name
+        # Bind the methods used for every read directly, so each call is not
+        # routed through the _f property. They are unbound again on close().
+        self.read = raw.read
+        self.readinto = raw.readinto
 
     def __enter__(self):
         return self
@@ -111,6 +118,8 @@ class ReadOnlyStream:
 
     def close(self):
         self._raw = None
+        vars(self).pop("read", None)
+        vars(self).pop("readinto", None)
 
     @property
     def _f(self):
@@ -171,9 +180,6 @@ class ReadOnlyStream:
     def writelines(self, lines):
         raise io.UnsupportedOperation(f"{type(self).__name__} is not writable")
 
-    def __del__(self):
-        return self.close()
-
     @property
     def name(self):
         if self._name is not None:
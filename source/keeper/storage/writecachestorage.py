@@ -1,7 +1,7 @@
 import contextlib
+import itertools
 import logging
 import threading
-import uuid
 from concurrent.futures.thread import ThreadPoolExecutor
 from io import BytesIO
 
@@ -13,15 +13,31 @@ logger = logging.getLogger(__name__)
 
 class WriteCacheStorage(Storage):
 
-    def __init__(self, storage: Storage):
+    def __init__(self, storage: Storage, max_workers=None):
+        """
+        Args:
+            storage: The underlying Storage to which cached data is written.
+
+            max_workers: The maximum number of threads writing cached data to
+                the underlying storage concurrently. Writes are I/O bound, so
+                more workers than cores can be beneficial, particularly for
+                remote storage. Defaults to the ThreadPoolExecutor default.
+
+        Raises:
+            ValueError: If the underlying storage is closed.
+        """
         if storage.closed:
             raise ValueError(f"Underlying storage is {storage} is closed")
         self._storage = storage
-        self._temp_buffer_lock = threading.RLock()
+        # The buffers are shared with the executor's threads. The lock is only
+        # held for a single operation or copy, so is held briefly, and makes
+        # those operations atomic without relying on the GIL.
+        self._buffers_lock = threading.Lock()
         self._temp_data = {}
-        self._data_lock = threading.RLock()
         self._data = {}
-        self._executor = ThreadPoolExecutor()
+        # Temporaries never leave this object, so their names need only be unique within it
+        self._temp_counter = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
 
     def close(self):
         self._executor.shutdown()
@@ -39,19 +55,26 @@ class WriteCacheStorage(Storage):
 
     def keys(self):
         """An iterator over all keys."""
-        with self._data_lock:
-            pending_keys = set(self._data.keys())
+        with self._buffers_lock:
+            pending_keys = set(self._data)
+        if not pending_keys:
+            yield from self.storage.keys()
+            return
         yield from pending_keys
+        # Filtered in C, while keeping the underlying keys lazy
+        yield from itertools.filterfalse(pending_keys.__contains__, self.storage.keys())
 
-        for key in self.storage.keys():
-            if key not in pending_keys:
-                yield key
+    def count(self):
+        """The number of keys."""
+        with self._buffers_lock:
+            pending_keys = list(self._data)
+        # Metadata is written through, so pending values are usually already counted
+        uncounted = sum(1 for key in pending_keys if not self.storage.has_meta(key))
+        return self.storage.count() + uncounted
 
-    @contextlib.contextmanager
     def openin_meta(self, key):
         # Metadata is not cached
-        with self._storage.openin_meta(key) as meta_file:
-            yield meta_file
+        return self._storage.openin_meta(key)
 
     @contextlib.contextmanager
     def openout_meta(self, key):
@@ -59,6 +82,17 @@ class WriteCacheStorage(Storage):
         with self._storage.openout_meta(key) as meta_file:
             yield meta_file
 
+    def write_meta(self, key, data):
+        # Metadata is not cached
+        self.storage.write_meta(key, data)
+
+    def has_meta(self, key):
+        # Metadata is not cached
+        return self.storage.has_meta(key)
+
+    def has_meta_many(self, keys):
+        return self.storage.has_meta_many(keys)
+
     @contextlib.contextmanager
     def openout_data(self, key):
         """
@@ -70,80 +104,108 @@ class WriteCacheStorage(Storage):
             type(self).__name__,
             key,
         )
-        with BytesIO() as buffer:
-            with WriteOnlyStream(buffer, name=key) as stream:
-                yield stream
-            with self._data_lock:
-                self._data[key] = buffer.getvalue()
+        buffer = _ChunkBuffer()
+        with WriteOnlyStream(buffer, name=key) as stream:
+            yield stream
+        data = buffer.getvalue()
+        with self._buffers_lock:
+            self._data[key] = data
+        self._executor.submit(self._write_buffer, key)
+
+    def write_data(self, key, data):
+        # The data is already complete, so is cached as is rather than copied into a buffer
+        data = bytes(data)
+        with self._buffers_lock:
+            self._data[key] = data
         self._executor.submit(self._write_buffer, key)
 
     def _write_buffer(self, key):
-        with self._data_lock:
-            buffer = self._data[key]
-        with self.storage.openout_data(key) as out:
-            out.write(buffer)
-        with self._data_lock:
-            del self._data[key]
+        with self._buffers_lock:
+            data = self._data.get(key)
+        if data is None:
+            # Discarded before it could be written
+            return
+        self.storage.write_data(key, data)
+        with self._buffers_lock:
+            # Unless it has been replaced since, in which case that write is still to come
+            if self._data.get(key) is data:
+                del self._data[key]
 
-    @contextlib.contextmanager
     def openin_data(self, key):
-        try:
-            with self._data_lock:
-                data = self._data[key]
-            with BytesIO(data) as buffer:
-                with ReadOnlyStream(buffer, name=key) as stream:
-                    yield stream
-        except KeyError:
-            with self.storage.openin_data(key) as stream:
-                yield stream
+        with self._buffers_lock:
+            data = self._data.get(key)
+        if data is None:
+            return self.storage.openin_data(key)
+        return ReadOnlyStream(BytesIO(data), name=key)
 
     @contextlib.contextmanager
     def openout_temp(self):
-        handle = str(uuid.uuid4())
-        with BytesIO() as buffer:
-            with WriteOnlyStream(buffer, name=handle) as stream:
-                yield stream
-            data = buffer.getvalue()
-        with self._temp_buffer_lock:
+        with self._buffers_lock:
+            handle = f"{next(self._temp_counter):x}"
+        buffer = _ChunkBuffer()
+        with WriteOnlyStream(buffer, name=handle) as stream:
+            yield stream
+        data = buffer.getvalue()
+        with self._buffers_lock:
             self._temp_data[handle] = data
 
     @contextlib.contextmanager
     def openin_temp(self, handle):
-        with self._temp_buffer_lock:
+        with self._buffers_lock:
             data = self._temp_data[handle]
         with BytesIO(data) as buffer:
             with ReadOnlyStream(buffer, name=handle) as stream:
                 yield stream
 
     def promote_temp(self, name, key):
-        self._executor.submit(self._promote_temp_buffer, name, key)
-
-    def _promote_temp_buffer(self, name, key):
-        with self._temp_buffer_lock:
-            data = self._temp_data[name]
-        with self._data_lock:
-            self._data[key] = data
-        with self.storage.openout_temp() as underlying_temp:
-            underlying_temp.write(data)
-        self.storage.promote_temp(underlying_temp.name, key)
-        with self._temp_buffer_lock:
-            del self._temp_data[name]
-        with self._data_lock:
-            del self._data[key]
+        # The buffer is cached under its key at once, so it can be read before it has been written
+        with self._buffers_lock:
+            self._data[key] = self._temp_data.pop(name)
+        self._executor.submit(self._write_buffer, key)
 
     def remove_temp(self, name):
-        with self._temp_buffer_lock:
+        with self._buffers_lock:
             del self._temp_data[name]
 
     def discard(self, key):
-        with self._data_lock:
-            try:
-                del self._data[key]
-            except KeyError:
-                pass
+        with self._buffers_lock:
+            self._data.pop(key, None)
         self.storage.discard(key)
 
     def __repr__(self):
         return f"{type(self).__name__}(storage={self.storage})"
 
 
+class _ChunkBuffer:
+    """An in-memory, write-only buffer which keeps the chunks written to it.
+
+    Unlike BytesIO, which reallocates its buffer as it grows, the chunks are
+    only joined, once, when the value is complete.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._length = 0
+
+    def write(self, b):
+        # A copy is only made if b is mutable
+        chunk = bytes(b)
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+        return len(chunk)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def tell(self):
+        return self._length
+
+    def getvalue(self):
+        return b"".join(self._chunks)
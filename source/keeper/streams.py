@@ -1,7 +1,6 @@
+import codecs
 import contextlib
-import hashlib
 import logging
-import pickle
 
 from keeper.values import ValueMeta
 
@@ -25,6 +24,10 @@ class WriteableBinaryStream:
         self._mime = mime
         self._keywords = kwargs
         self._key = None
+        self._digester = self._keeper._new_digester()
+        self._length = 0
+        # Created when a string is first written
+        self._encoder = None
 
     def __enter__(self):
         return self
@@ -46,37 +49,63 @@ class WriteableBinaryStream:
         return self._key
 
     def write(self, data):
-        self._file.write(data)
+        """Write data to the stream.
+
+        Args:
+            data: Bytes, or if the stream has an encoding, a string.
+
+        Returns:
+            The number of bytes, or for a string characters, written.
+
+        Raises:
+            TypeError: If data is a string and the stream has no encoding.
+        """
+        if isinstance(data, str):
+            if self._encoder is None:
+                if self._encoding is None:
+                    raise TypeError("Cannot write str to a stream without an encoding")
+                # Strings are encoded once, as they are written, so the stored bytes can be hashed directly
+                self._encoder = codecs.getincrementalencoder(self._encoding)()
+            self._write_bytes(self._encoder.encode(data))
+            return len(data)
+        return self._write_bytes(data)
+
+    def _write_bytes(self, data):
+        # Hash the data on its way out, so the temporary need not be read back on close
+        n = self._file.write(data)
+        self._digester.update(data)
+        self._length += n
+        return n
 
     @property
     def closed(self):
         return self._key is not None
 
+    def _discard(self):
+        """Close the stream, throwing away its data rather than adding it."""
+        self._stack.close()
+        self._keeper.storage.remove_temp(self._file.name)
+
     def close(self):
         logger.debug("%s closing", type(self).__name__)
         if self.closed:
             logger.debug("%s already closed, returning key %r", type(self).__name__, self._key)
             return self._key
 
+        if self._encoder is not None:
+            # Complete any partially encoded characters
+            self._write_bytes(self._encoder.encode("", final=True))
         self._stack.close()
         assert self._file.closed
-        logger.debug("%s reopening %r", type(self).__name__, self._file.name)
         logger.debug("%s computing key...", type(self).__name__)
 
         handle = self._file.name
-
-        with self._keeper.storage.openin_temp(handle) as temp_file:
-            digester = hashlib.sha1()
-            while True:
-                data = temp_file.read(16 * 1024 * 1024)
-                if not data:
-                    break
-                digester.update(data)
-            length = temp_file.tell()
+        digester = self._digester
+        length = self._length
 
         meta = ValueMeta(length=length, mime=self._mime, encoding=self._encoding,
                          **self._keywords)
-        serialised_meta = pickle.dumps(meta)
+        serialised_meta = meta.serialise()
         digester.update(serialised_meta)
         key = digester.hexdigest()
         logger.debug("%s key computed as %r", type(self).__name__, key)
@@ -88,8 +117,8 @@ class WriteableBinaryStream:
                 self._file.name
             )
             self._keeper.storage.promote_temp(handle, key)
-            with self._keeper.storage.openout_meta(key) as meta_file:
-                meta_file.write(serialised_meta)
+            self._keeper.storage.write_meta(key, serialised_meta)
+            self._keeper._cache_meta(key, meta)
         else:
             self._keeper.storage.remove_temp(handle)
         logger.debug("%s closed, returning key %r", type(self).__name__, key)
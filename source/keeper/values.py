@@ -1,53 +1,195 @@
 
+import io
+import json
+import mmap
+import os
 import pickle
 import logging
+import shutil
+import struct
 
 
 logger = logging.getLogger(__name__)
 
+# The encoding of strings added without one, and of values read as strings
+# which have none recorded
+DEFAULT_ENCODING = "utf-8"
+
+# Values at least this long are memory-mapped, rather than read, by as_memoryview()
+MMAP_THRESHOLD = 64 * 1024
+
+# Serialised metadata starting with this byte is packed; anything else is a pickle
+META_FORMAT_VERSION = b'\x01'
+
+# Packed metadata is this header, the mime and encoding strings, then any
+# further metadata as JSON
+_meta_header = struct.Struct('<cQHH')
+_MAX_LENGTH = 2 ** 64 - 1
+_NONE_STRING_LENGTH = 0xFFFF
+
+_JSON_TYPES = frozenset((str, int, float, bool, type(None)))
+
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+
 
 class ValueMeta:
     """
     Immutable meta data for a value.
     """
+    __slots__ = ('length', 'mime', 'encoding', '_extras')
+
     def __init__(self, length, mime=None, encoding=None, **kwargs):
-        self._keywords = {'length': length,
-                          'mime': mime,
-                          'encoding': encoding,
-                          }
-        self._keywords.update(kwargs)
+        self.length = length
+        self.mime = mime
+        self.encoding = encoding
+        self._extras = kwargs
 
     def __getattr__(self, item):
-        if item == "_keywords":
-            raise AttributeError
+        # Only reached for arbitrary meta data; length, mime and encoding are slots
+        if item == "_extras":
+            raise AttributeError(item)
         try:
-            return self._keywords[item]
+            return self._extras[item]
         except KeyError:
-            raise AttributeError
+            raise AttributeError(item)
 
     def __iter__(self):
-        yield from self._keywords.keys()
+        yield 'length'
+        yield 'mime'
+        yield 'encoding'
+        yield from self._extras.keys()
 
     def __contains__(self, item):
-        return item in self._keywords
+        return item in ('length', 'mime', 'encoding') or item in self._extras
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        # Instances pickled by earlier versions kept everything in _keywords
+        self.__init__(**state.get('_keywords', state))
 
     def to_dict(self):
-        return self._keywords
+        return {'length': self.length, 'mime': self.mime, 'encoding': self.encoding, **self._extras}
+
+    def serialise(self) -> bytes:
+        """Serialise this metadata to bytes.
+
+        The length, mime and encoding are packed into a fixed binary header,
+        followed by any further metadata as JSON. This is used when every
+        value is a str, int, float, bool or None, so it round-trips exactly.
+        Otherwise the metadata is pickled.
+        """
+        length = self.length
+        if (type(length) is int and 0 <= length <= _MAX_LENGTH
+                and all(type(value) in _JSON_TYPES for value in self._extras.values())):
+            try:
+                mime_length, mime = _pack_string(self.mime)
+                encoding_length, encoding = _pack_string(self.encoding)
+            except ValueError:
+                pass
+            else:
+                header = _meta_header.pack(META_FORMAT_VERSION, length, mime_length, encoding_length)
+                extras = _json_encoder.encode(self._extras).encode("utf-8") if self._extras else b''
+                return b''.join((header, mime, encoding, extras))
+        return pickle.dumps(self)
+
+    @classmethod
+    def deserialise(cls, data) -> "ValueMeta":
+        """Reconstruct metadata from bytes produced by serialise().
+
+        Pickled metadata, as written by earlier versions, is also accepted.
+        """
+        prefix = data[:1]
+        if prefix == META_FORMAT_VERSION:
+            _, length, mime_length, encoding_length = _meta_header.unpack_from(data)
+            offset = _meta_header.size
+            mime, offset = _unpack_string(data, offset, mime_length)
+            encoding, offset = _unpack_string(data, offset, encoding_length)
+            extras = json.loads(data[offset:]) if offset < len(data) else {}
+            return cls(length, mime, encoding, **extras)
+        return pickle.loads(data)
+
+
+def _pack_string(text):
+    """The header length field and UTF-8 bytes for an optional string.
+
+    Raises:
+        ValueError: If text is neither None nor a str short enough to pack.
+    """
+    if text is None:
+        return _NONE_STRING_LENGTH, b''
+    if type(text) is not str:
+        raise ValueError(f"Cannot pack {type(text).__name__}")
+    encoded = text.encode("utf-8")
+    if len(encoded) >= _NONE_STRING_LENGTH:
+        raise ValueError(f"Cannot pack string of {len(encoded)} bytes")
+    return len(encoded), encoded
+
+
+def _unpack_string(data, offset, length):
+    """The optional string at offset in data, and the offset following it."""
+    if length == _NONE_STRING_LENGTH:
+        return None, offset
+    end = offset + length
+    return str(data[offset:end], "utf-8"), end
+
+
+def _sendfile(out_fd, in_fd, length):
+    """Copy length bytes from the start of in_fd to out_fd.
+
+    Returns:
+        The number of bytes copied, or None if the operating system cannot
+        copy between these descriptors, in which case nothing was copied.
+    """
+    if not hasattr(os, "sendfile"):
+        return None
+    offset = 0
+    while offset < length:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset, length - offset)
+        except OSError:
+            if offset == 0:
+                return None
+            raise
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+
+def read_meta(storage, key) -> ValueMeta:
+    """Read the metadata for key from storage.
+
+    Raises:
+        KeyError: If there is no metadata for key.
+    """
+    try:
+        with storage.openin_meta(key) as meta_file:
+            return ValueMeta.deserialise(meta_file.read())
+    except FileNotFoundError:
+        raise KeyError(key)
 
 
 class Value:
     """Access to a value and its metadata.
     """
 
-    def __init__(self, keeper, key):
+    def __init__(self, keeper, key, meta=None):
+        """
+        Args:
+            keeper: The Keeper containing the value.
+            key: The key of the value.
+            meta: The ValueMeta of the value, if already known. If None (the
+                default) it is read from the keeper's storage.
+
+        Raises:
+            KeyError: If meta is None and there is no value with key.
+        """
         self._keeper = keeper
         self._key = key
 
-        try:
-            with self._keeper.storage.openin_meta(self._key) as meta_file:
-                self._meta = pickle.load(meta_file)
-        except FileNotFoundError:
-            raise KeyError(key)
+        self._meta = meta if meta is not None else read_meta(self._keeper.storage, key)
 
     @property
     def meta(self) -> ValueMeta:
@@ -65,6 +207,22 @@ class Value:
             data = data_file.read()
         return data
 
+    def as_memoryview(self):
+        """Access the value as a read-only memoryview.
+
+        Large values are memory-mapped where the storage permits, so their
+        data is not copied into the Python heap.
+        """
+        with self._keeper.storage.openin_data(self._key) as data_file:
+            if self._meta.length >= MMAP_THRESHOLD:
+                try:
+                    fileno = data_file.fileno()
+                except (AttributeError, io.UnsupportedOperation):
+                    pass
+                else:
+                    return memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+            return memoryview(data_file.read())
+
     def as_file(self):
         """Access the data as a read-only binary file-like object.
         """
@@ -72,6 +230,38 @@ class Value:
             self._key
         )
 
+    def copy_to(self, file):
+        """Copy the data to a writable binary file-like object.
+
+        Where both the stored data and file are backed by file descriptors,
+        such as a regular file, pipe or socket, the data is copied by the
+        operating system without passing through Python.
+
+        Args:
+            file: A writable binary file-like object.
+
+        Returns:
+            The number of bytes copied.
+        """
+        with self.as_file() as data_file:
+            try:
+                in_fd = data_file.fileno()
+                out_fd = file.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                pass
+            else:
+                file.flush()
+                copied = _sendfile(out_fd, in_fd, self._meta.length)
+                if copied is not None:
+                    try:
+                        # Bring file's idea of its position up to date with the descriptor
+                        file.seek(0, io.SEEK_CUR)
+                    except (AttributeError, OSError):
+                        pass
+                    return copied
+            shutil.copyfileobj(data_file, file)
+        return self._meta.length
+
     def as_string(self):
         """Return the data as a string.
 
@@ -79,9 +269,13 @@ class Value:
         encoding in self.meta.encoding or the default string encoding if the
         former is None.
         """
-        with self._keeper.storage.openin_data(self._key) as data_file:
-            s = data_file.read().decode(encoding=self.meta.encoding)
-        return s
+        # Large values are decoded directly from the mapped file, so the
+        # undecoded bytes are never copied into memory alongside the string
+        encoding = self._meta.encoding
+        if encoding is None:
+            encoding = DEFAULT_ENCODING
+        with self.as_memoryview() as data:
+            return str(data, encoding)
 
     def __str__(self):
         """Return the data as a string.
@@ -1,8 +1,6 @@
 import logging
-import sys
+import os
 
-logging.basicConfig(level=logging.DEBUG)
-console = logging.StreamHandler(sys.stdout)
-console.setLevel(logging.DEBUG)
-# add the handler to the root logger
-logging.getLogger().addHandler(console)
+# Debug logging formats a message for every storage operation, so it is only
+# enabled on request, by setting KEEPER_TEST_LOGLEVEL=DEBUG
+logging.basicConfig(level=os.environ.get("KEEPER_TEST_LOGLEVEL", "WARNING"))
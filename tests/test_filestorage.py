@@ -1,6 +1,10 @@
+import errno
 import os
-import shutil
+import tempfile
+import threading
 import unittest
+import unittest.mock
+from pathlib import Path
 
 from keeper.storage.filestorage import FileStorage
 
@@ -8,19 +12,13 @@ from keeper.storage.filestorage import FileStorage
 class FileStorageTests(unittest.TestCase):
 
     def setUp(self):
-        self.keeper_root = 'testkeeper'
-        self._remove_rootdir()
+        # Under TMPDIR, which may be a RAM disk, rather than the working directory.
+        # The root itself is left for each test to create, or not.
+        self.parent_directory = tempfile.TemporaryDirectory(prefix='keeper-')
+        self.keeper_root = os.path.join(self.parent_directory.name, 'testkeeper')
 
     def tearDown(self):
-        self._remove_rootdir()
-
-    def _remove_rootdir(self):
-        shutil.rmtree(self.keeper_root, ignore_errors=True)
-        if os.path.exists(self.keeper_root):
-            if os.path.isdir(self.keeper_root):
-                os.rmdir(self.keeper_root)
-            if os.path.isfile(self.keeper_root):
-                os.unlink(self.keeper_root)
+        self.parent_directory.cleanup()
 
     def test_construction_does_not_raise_exception_when_dirpath_available(self):
         fs = FileStorage(self.keeper_root)
@@ -30,18 +28,21 @@ class FileStorageTests(unittest.TestCase):
         FileStorage(self.keeper_root)
 
     def test_dirpath_already_exists_as_file_raises_file_exists_error(self):
-        try:
-            os.close(os.open(self.keeper_root, os.O_CREAT))
-            with self.assertRaises(FileExistsError):
-                FileStorage(self.keeper_root)
-        finally:
-            shutil.rmtree(self.keeper_root, ignore_errors=True)
+        os.close(os.open(self.keeper_root, os.O_CREAT))
+        with self.assertRaises(FileExistsError):
+            FileStorage(self.keeper_root)
 
     def test_construction_does_not_raise_exception_when_dirpath_temp_is_existing_dir(self):
         os.mkdir(self.keeper_root)
         os.mkdir(os.path.join(self.keeper_root, "temp"))
         FileStorage(self.keeper_root)
 
+    def test_construction_removes_leftover_temporaries(self):
+        os.makedirs(os.path.join(self.keeper_root, "temp", "subdir"))
+        os.close(os.open(os.path.join(self.keeper_root, "temp", "leftover"), os.O_CREAT))
+        FileStorage(self.keeper_root)
+        self.assertEqual(os.listdir(os.path.join(self.keeper_root, "temp")), [])
+
     def test_dirpath_temp_already_exists_as_file_raises_file_exists_error(self):
         os.mkdir(self.keeper_root)
         temp_dirpath = os.path.join(self.keeper_root, "temp")
@@ -62,3 +63,213 @@ class FileStorageTests(unittest.TestCase):
         os.close(os.open(data_dirpath, os.O_CREAT))
         with self.assertRaises(FileExistsError):
             FileStorage(self.keeper_root)
+
+    def test_has_meta_negative(self):
+        fs = FileStorage(self.keeper_root)
+        self.assertFalse(fs.has_meta('2a206783b16f327a53555861331980835a0e059e'))
+
+    def test_has_meta_positive(self):
+        fs = FileStorage(self.keeper_root)
+        with fs.openout_meta('2a206783b16f327a53555861331980835a0e059e') as meta_file:
+            meta_file.write(b'meta')
+        self.assertTrue(fs.has_meta('2a206783b16f327a53555861331980835a0e059e'))
+
+    def test_has_meta_many_accepts_an_iterator(self):
+        fs = FileStorage(self.keeper_root)
+        present = '2a206783b16f327a53555861331980835a0e059e'
+        absent = '2a206783b16f327a53555861331980835a0e059f'
+        fs.write_meta(present, b'meta')
+        self.assertEqual(fs.has_meta_many(iter([present, absent])), {present})
+
+    def test_keys(self):
+        fs = FileStorage(self.keeper_root)
+        keys = {'2a206783b16f327a53555861331980835a0e059e', '2a20ffffb16f327a53555861331980835a0e059e'}
+        for key in keys:
+            with fs.openout_meta(key) as meta_file:
+                meta_file.write(b'meta')
+        self.assertEqual(set(fs.keys()), keys)
+
+    def test_count(self):
+        fs = FileStorage(self.keeper_root)
+        keys = {'2a206783b16f327a53555861331980835a0e059e', '2a20ffffb16f327a53555861331980835a0e059e'}
+        for key in keys:
+            with fs.openout_meta(key) as meta_file:
+                meta_file.write(b'meta')
+        self.assertEqual(fs.count(), 2)
+
+    def test_write_meta(self):
+        fs = FileStorage(self.keeper_root)
+        fs.write_meta('2a206783b16f327a53555861331980835a0e059e', b'meta')
+        with fs.openin_meta('2a206783b16f327a53555861331980835a0e059e') as meta_file:
+            self.assertEqual(meta_file.read(), b'meta')
+        self.assertEqual(list(fs.keys()), ['2a206783b16f327a53555861331980835a0e059e'])
+        self.assertEqual(os.listdir(os.path.join(self.keeper_root, 'temp')), [])
+
+    def test_write_data(self):
+        fs = FileStorage(self.keeper_root)
+        fs.write_data('2a206783b16f327a53555861331980835a0e059e', b'data')
+        with fs.openin_data('2a206783b16f327a53555861331980835a0e059e') as data_file:
+            self.assertEqual(data_file.read(), b'data')
+        self.assertEqual(os.listdir(os.path.join(self.keeper_root, 'temp')), [])
+
+    def test_batch_defers_meta_files(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        with fs.batch():
+            fs.write_meta(key, b'meta')
+            self.assertTrue(fs.has_meta(key))
+            self.assertEqual(list(fs.keys()), [key])
+            self.assertEqual(fs.count(), 1)
+            with fs.openin_meta(key) as meta_file:
+                self.assertEqual(meta_file.read(), b'meta')
+            self.assertFalse(os.path.exists(os.path.join(self.keeper_root, 'meta', '2', 'a', '2', '0')))
+        with open(os.path.join(self.keeper_root, 'meta', '2', 'a', '2', '0', '6783b16f327a53555861331980835a0e059e.pickle'), 'rb') as meta_file:
+            self.assertEqual(meta_file.read(), b'meta')
+        self.assertEqual(os.listdir(os.path.join(self.keeper_root, 'temp')), [])
+
+    def test_discard_within_batch(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        with fs.batch():
+            fs.write_meta(key, b'meta')
+            fs.discard(key)
+            self.assertFalse(fs.has_meta(key))
+        self.assertFalse(fs.has_meta(key))
+
+    def test_batch_makes_data_durable_on_exit(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        with unittest.mock.patch('keeper.storage.filestorage._sync_files') as sync_files:
+            with fs.batch():
+                fs.write_data(key, b'data')
+                fs.write_meta(key, b'meta')
+                sync_files.assert_not_called()
+        synced = [path for call in sync_files.call_args_list for path in call.args[0]]
+        self.assertIn(fs._data_path(key), synced)
+        with fs.openin_data(key) as data_file:
+            self.assertEqual(data_file.read(), b'data')
+        self.assertTrue(fs.has_meta(key))
+
+    def test_batch_flush_syncs_only_its_own_files(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        with unittest.mock.patch('os.sync') as sync:
+            with unittest.mock.patch('keeper.storage.filestorage._sync_file') as sync_file:
+                with fs.batch():
+                    fs.write_data(key, b'data')
+                    fs.write_meta(key, b'meta')
+        sync.assert_not_called()
+        self.assertIn(unittest.mock.call(fs._data_path(key)), sync_file.call_args_list)
+
+    def test_write_outside_batch_in_another_thread_is_durable_on_return(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        entered = threading.Event()
+        written = threading.Event()
+
+        def batched():
+            with fs.batch():
+                fs.write_data('2a206783b16f327a53555861331980835a0e059f', b'batched')
+                entered.set()
+                written.wait(5)
+
+        thread = threading.Thread(target=batched)
+        thread.start()
+        try:
+            entered.wait(5)
+            fs.write_data(key, b'data')
+            fs.write_meta(key, b'meta')
+            self.assertNotIn(fs._data_path(key), fs._unsynced_data_paths)
+            self.assertNotIn(key, fs._pending_meta)
+            self.assertTrue(os.path.exists(fs._meta_filepath(key)))
+        finally:
+            written.set()
+            thread.join()
+
+    def test_batch_defers_directory_sync_of_discard(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        fs.write_data(key, b'data')
+        fs.write_meta(key, b'meta')
+        with unittest.mock.patch('keeper.storage.filestorage._sync_directories') as sync_directories:
+            with unittest.mock.patch('atomicwrites._sync_directory') as sync_directory:
+                with fs.batch():
+                    fs.discard(key)
+                sync_directory.assert_not_called()
+        synced = [path for call in sync_directories.call_args_list for path in call.args[0]]
+        self.assertIn(fs._data_path(key).parent, synced)
+        self.assertFalse(fs.has_meta(key))
+
+    def test_promote_temp_across_devices(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        with fs.openout_temp() as temp:
+            temp.write(b'data')
+        cross_device = OSError(errno.EXDEV, "Invalid cross-device link")
+        with unittest.mock.patch('os.replace', side_effect=[cross_device, None]) as replace:
+            fs.promote_temp(temp.name, key)
+        staging_path, data_path = replace.call_args.args
+        self.assertEqual(data_path, fs._data_path(key))
+        with open(staging_path, 'rb') as staging_file:
+            self.assertEqual(staging_file.read(), b'data')
+        self.assertFalse(fs._temp_path(temp.name).exists())
+
+    def test_clashing_temporary_name_does_not_truncate_existing_temporary(self):
+        fs = FileStorage(self.keeper_root)
+        with fs.openout_temp() as temp:
+            temp.write(b'data')
+        with unittest.mock.patch(
+            'keeper.storage.filestorage._new_temp_name', return_value=temp.name
+        ):
+            with self.assertRaises(FileExistsError):
+                with fs.openout_temp():
+                    pass
+        with fs.openin_temp(temp.name) as temp_file:
+            self.assertEqual(temp_file.read(), b'data')
+
+    def test_write_data_across_devices(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        cross_device = OSError(errno.EXDEV, "Invalid cross-device link")
+        replace = os.replace
+        calls = []
+
+        def replace_across_devices(source, destination):
+            # Only renames out of temp/ cross devices
+            if Path(source).parent == fs._temp_path('x').parent:
+                calls.append(destination)
+                raise cross_device
+            replace(source, destination)
+
+        with unittest.mock.patch('os.replace', side_effect=replace_across_devices):
+            fs.write_data(key, b'data')
+            with fs.batch():
+                fs.write_meta(key, b'meta')
+        self.assertEqual(calls, [fs._data_path(key), fs._meta_path(key)])
+        with fs.openin_data(key) as data_file:
+            self.assertEqual(data_file.read(), b'data')
+        with fs.openin_meta(key) as meta_file:
+            self.assertEqual(meta_file.read(), b'meta')
+        self.assertEqual(os.listdir(os.path.join(self.keeper_root, 'temp')), [])
+
+    def test_directories_are_created_once(self):
+        fs = FileStorage(self.keeper_root)
+        fs.write_data('2a206783b16f327a53555861331980835a0e059e', b'data')
+        with unittest.mock.patch.object(Path, 'mkdir') as mkdir:
+            fs.write_data('2a206783b16f327a53555861331980835a0e059f', b'more data')
+        mkdir.assert_not_called()
+
+    def test_batch_makes_promoted_temp_durable_on_exit(self):
+        fs = FileStorage(self.keeper_root)
+        key = '2a206783b16f327a53555861331980835a0e059e'
+        with unittest.mock.patch('keeper.storage.filestorage._sync_files') as sync_files:
+            with fs.batch():
+                with fs.openout_temp() as temp:
+                    temp.write(b'data')
+                fs.promote_temp(temp.name, key)
+                fs.write_meta(key, b'meta')
+                sync_files.assert_not_called()
+        synced = [path for call in sync_files.call_args_list for path in call.args[0]]
+        self.assertIn(fs._data_path(key), synced)
+        with fs.openin_data(key) as data_file:
+            self.assertEqual(data_file.read(), b'data')
@@ -0,0 +1,43 @@
+import unittest
+from unittest.mock import Mock
+
+from keeper.storage.indexedstorage import IndexedStorage
+
+
+class TestIndexedStorage(unittest.TestCase):
+
+    def test_constructing_with_closed_underlying_storage_raises_value_error(self):
+        storage = Mock(closed=True)
+        with self.assertRaises(ValueError):
+            IndexedStorage(storage)
+
+    def test_closing_does_not_close_underlying_storage(self):
+        storage = Mock(closed=False)
+        f = IndexedStorage(storage)
+        f.close()
+        storage.close.assert_not_called()
+
+    def test_is_closed_after_closing(self):
+        storage = Mock(closed=False)
+        f = IndexedStorage(storage)
+        f.close()
+        self.assertTrue(f.closed)
+
+    def test_index_is_built_once(self):
+        storage = Mock(closed=False)
+        storage.keys.return_value = iter(['abcdef', '012345'])
+        f = IndexedStorage(storage)
+        self.assertTrue(f.has_meta('abcdef'))
+        self.assertFalse(f.has_meta('fedcba'))
+        self.assertEqual(f.count(), 2)
+        self.assertEqual(set(f.keys()), {'abcdef', '012345'})
+        storage.keys.assert_called_once_with()
+        storage.has_meta.assert_not_called()
+
+    def test_discard_removes_from_index(self):
+        storage = Mock(closed=False)
+        storage.keys.return_value = iter(['abcdef'])
+        f = IndexedStorage(storage)
+        f.discard('abcdef')
+        self.assertFalse(f.has_meta('abcdef'))
+        storage.discard.assert_called_once_with('abcdef')
@@ -1,43 +1,49 @@
-import logging
+import importlib.util
+import io
 import os
+import random
 import sys
-import shutil
+import tempfile
 import time
 import unittest
+import unittest.mock
 
 from keeper import Keeper
 from keeper.storage.filestorage import FileStorage
+from keeper.storage.indexedstorage import IndexedStorage
 from keeper.storage.writecachestorage import WriteCacheStorage
 
-logging.basicConfig(level=logging.DEBUG)
-console = logging.StreamHandler(sys.stdout)
-console.setLevel(logging.DEBUG)
-logging.getLogger().addHandler(console)
+# Generated once, with a seeded generator, which is much cheaper than reading
+# the kernel's random source in each test. Tests use prefixes of it.
+RANDOM_DATA = random.Random(0).randbytes(10 * 1024 * 1024)
+
+# Tests with the largest values are only run on request, by setting KEEPER_TEST_SLOW=1
+RUN_SLOW_TESTS = bool(os.environ.get("KEEPER_TEST_SLOW"))
+
+DEFAULT_ENCODING = sys.getdefaultencoding()
 
 
 class TestKeeperOnFileStorage(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Under TMPDIR, which may be a RAM disk, rather than the working directory
+        cls.root_directory = tempfile.TemporaryDirectory(prefix='keeper-')
+        cls.root_dirpath = cls.root_directory.name
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.root_directory.cleanup()
+
     def setUp(self):
-        self.original_stream = console.stream
-        console.stream = sys.stdout
-        self.keeper_root = 'testkeeper'
-        shutil.rmtree(self.keeper_root, ignore_errors=True)
-
-        try:
-            os.mkdir(self.keeper_root)
-        except FileExistsError:
-            pass
+        # Each test has its own store within the directory shared by the class
+        self.keeper_root = os.path.join(self.root_dirpath, self._testMethodName)
         self.storage = FileStorage(self.keeper_root)
         self.keeper = Keeper(self.storage)
 
     def tearDown(self):
         self.keeper.close()
         self.storage.close()
-        try:
-            shutil.rmtree(self.keeper_root)
-        except FileNotFoundError:
-            pass
-        console.stream = self.original_stream
 
     def test_create(self):
         pass
@@ -87,7 +93,7 @@ class TestKeeperOnFileStorage(unittest.TestCase):
         string = "It was the best of times. It was the worst of times."
         key1 = self.keeper.add(string)
         value = self.keeper[key1]
-        self.assertEqual(value.meta.encoding, sys.getdefaultencoding())
+        self.assertEqual(value.meta.encoding, DEFAULT_ENCODING)
 
     def test_unknown_key(self):
         with self.assertRaises(KeyError):
@@ -104,6 +110,11 @@ class TestKeeperOnFileStorage(unittest.TestCase):
         key = self.keeper.add(data, encoding='utf-16')
         self.assertEqual(self.keeper[key].as_string(), string)
 
+    def test_add_bytes_without_encoding_retrieve_string(self):
+        string = "søker sjåfør"
+        key = self.keeper.add(string.encode())
+        self.assertEqual(self.keeper[key].as_string(), string)
+
     def test_add_string_retrieve_bytes(self):
         string = "søker sjåfør"
         key = self.keeper.add(string)
@@ -158,6 +169,10 @@ class TestKeeperOnFileStorage(unittest.TestCase):
         self.assertIn('filename', attributes)
         self.assertIn('author', attributes)
 
+    def test_non_json_metadata(self):
+        key = self.keeper.add(b'gdgdgdggd', tags=('a', 'b'))
+        self.assertEqual(self.keeper[key].meta.tags, ('a', 'b'))
+
     def test_meta_keys_distinct(self):
         string = "<!DOCTYPE html><html><body><b>Thunderbirds are go</b></body></html>"
         key1 = self.keeper.add(string, mime="text/html")
@@ -170,11 +185,73 @@ class TestKeeperOnFileStorage(unittest.TestCase):
         self.assertNotEqual(key1, key2)
 
     def test_large_data(self):
-        data = os.urandom(10 * 1024 * 1024)
+        data = RANDOM_DATA[:1024 * 1024]
         key = self.keeper.add(data)
         data2 = self.keeper[key].as_bytes()
         self.assertEqual(data, data2)
 
+    @unittest.skipUnless(RUN_SLOW_TESTS, "set KEEPER_TEST_SLOW=1 to run")
+    def test_very_large_data(self):
+        data = RANDOM_DATA[:10 * 1024 * 1024]
+        key = self.keeper.add(data)
+        data2 = self.keeper[key].as_bytes()
+        self.assertEqual(data, data2)
+
+    def test_as_memoryview(self):
+        data = b'The quick brown fox jumped over the lazy dog.'
+        key = self.keeper.add(data)
+        self.assertEqual(self.keeper[key].as_memoryview(), data)
+
+    def test_large_as_memoryview(self):
+        data = RANDOM_DATA[:1024 * 1024]
+        key = self.keeper.add(data)
+        self.assertEqual(self.keeper[key].as_memoryview(), data)
+
+    def test_copy_to_file(self):
+        data = RANDOM_DATA[:100 * 1024]
+        key = self.keeper.add(data)
+        with tempfile.TemporaryFile() as file:
+            file.write(b'header')
+            self.assertEqual(self.keeper[key].copy_to(file), len(data))
+            file.write(b'trailer')
+            file.seek(0)
+            self.assertEqual(file.read(), b'header' + data + b'trailer')
+
+    def test_copy_to_file_like_object(self):
+        data = RANDOM_DATA[:100 * 1024]
+        key = self.keeper.add(data)
+        buffer = io.BytesIO()
+        self.assertEqual(self.keeper[key].copy_to(buffer), len(data))
+        self.assertEqual(buffer.getvalue(), data)
+
+    def test_large_string(self):
+        string = "søker sjåfør " * 200000
+        key = self.keeper.add(string, encoding='utf-16')
+        self.assertEqual(self.keeper[key].as_bytes(), string.encode('utf-16'))
+
+    def test_unencodable_string_is_not_added(self):
+        with self.assertRaises(UnicodeEncodeError):
+            self.keeper.add("søker sjåfør " * 200000 + "\u20ac", encoding='latin-1')
+        self.assertEqual(len(self.keeper), 0)
+
+    def test_scan_meta(self):
+        key1 = self.keeper.add(b'hsgshsgsha', mime="text/plain")
+        key2 = self.keeper.add(b'fdfdsffsdf', author="Joe Bloggs")
+        metas = dict(self.keeper.scan_meta())
+        self.assertEqual(set(metas), {key1, key2})
+        self.assertEqual(metas[key1].mime, "text/plain")
+        self.assertEqual(metas[key2].author, "Joe Bloggs")
+
+    def test_scan_meta_skips_unknown_keys(self):
+        key = self.keeper.add(b'hsgshsgsha')
+        metas = list(self.keeper.scan_meta(['2a206783b16f327a53555861331980835a0e059e', key]))
+        self.assertEqual([k for k, _ in metas], [key])
+
+    def test_scan_meta_skips_malformed_keys(self):
+        key = self.keeper.add(b'hsgshsgsha')
+        metas = list(self.keeper.scan_meta(['2a2', 42, None, key]))
+        self.assertEqual([k for k, _ in metas], [key])
+
     def test_contains_negative(self):
         self.assertNotIn('2a206783b16f327a53555861331980835a0e059e', self.keeper)
 
@@ -182,6 +259,42 @@ class TestKeeperOnFileStorage(unittest.TestCase):
         key = self.keeper.add("Some data")
         self.assertIn(key, self.keeper)
 
+    def test_contains_many(self):
+        key1 = self.keeper.add(b'hsgshsgsha')
+        key2 = self.keeper.add(b'fdfdsffsdf')
+        absent1 = key1[:-1] + ('0' if key1[-1] != '0' else '1')  # In the same directory as key1
+        absent2 = '2a206783b16f327a53555861331980835a0e059e'
+        keeper = Keeper(self.storage)
+        self.assertEqual(
+            keeper.contains_many([key1, absent1, key2, absent2]),
+            {key1: True, absent1: False, key2: True, absent2: False},
+        )
+
+    def test_contains_malformed_key(self):
+        self.assertNotIn('2a2', self.keeper)
+        self.assertNotIn(42, self.keeper)
+        self.assertEqual(self.keeper.contains_many(['2a2']), {'2a2': False})
+
+    def test_len_agrees_with_iteration_when_digests_are_mixed(self):
+        self.keeper.add(b'Some data')
+        with Keeper(self.storage, digest="sha256") as other:
+            other.add(b'More data')
+        self.assertEqual(len(self.keeper), len(list(self.keeper)))
+        self.assertEqual(len(list(self.keeper.scan_meta())), len(self.keeper))
+
+    def test_get_after_removal_through_another_keeper_raises_key_error(self):
+        key = self.keeper.add(b'Some data')
+        _ = self.keeper[key]
+        other = Keeper(self.storage)
+        del other[key]
+        self.assertNotIn(key, self.keeper)
+        with self.assertRaises(KeyError):
+            _ = self.keeper[key]
+
+    def test_get_malformed_key_raises_key_error(self):
+        with self.assertRaises(KeyError):
+            _ = self.keeper['2a2']
+
     def test_remove_item_positive(self):
         text = "We'll attach some arbitrary meta data to this"
         key = self.keeper.add(text, mime="text/plain", filename="foo.txt", author="Joe Bloggs")
@@ -193,30 +306,102 @@ class TestKeeperOnFileStorage(unittest.TestCase):
         with self.assertRaises(KeyError):
             _ = self.keeper['2a206783b16f327a53555861331980835a0e059e']
 
+    def test_get_removed_item_raises_key_error(self):
+        key = self.keeper.add("Some data")
+        _ = self.keeper[key]
+        del self.keeper[key]
+        with self.assertRaises(KeyError):
+            _ = self.keeper[key]
+
+    def test_repeated_get_reads_meta_once(self):
+        key = self.keeper.add("Some data", mime="text/plain")
+        keeper = Keeper(self.storage)
+        with unittest.mock.patch.object(
+            self.storage, 'openin_meta', wraps=self.storage.openin_meta
+        ) as openin_meta:
+            self.assertEqual(keeper[key].meta.mime, "text/plain")
+            self.assertEqual(keeper[key].meta.mime, "text/plain")
+        openin_meta.assert_called_once_with(key)
+
+    def test_add_after_removal_through_another_keeper(self):
+        key = self.keeper.add(b'Some data')
+        other = Keeper(self.storage)
+        del other[key]
+        self.assertNotIn(key, self.keeper)
+        self.assertEqual(self.keeper.add(b'Some data'), key)
+        self.assertEqual(self.keeper[key].as_bytes(), b'Some data')
+
+    def test_copy_from(self):
+        with tempfile.TemporaryDirectory() as other_root:
+            other = Keeper(FileStorage(other_root))
+            key = other.add("Some data", mime="text/plain", author="Joe Bloggs")
+            self.assertEqual(self.keeper.copy_from(other, key), key)
+            other.close()
+        self.assertEqual(self.keeper[key].as_string(), "Some data")
+        self.assertEqual(self.keeper[key].meta.author, "Joe Bloggs")
+        self.assertEqual(self.keeper.add("Some data", mime="text/plain", author="Joe Bloggs"), key)
+        self.assertEqual(len(self.keeper), 1)
+
+    def test_copy_from_with_different_digest_raises_value_error(self):
+        with tempfile.TemporaryDirectory() as other_root:
+            other = Keeper(FileStorage(other_root), digest="sha256")
+            key = other.add("Some data")
+            with self.assertRaises(ValueError):
+                self.keeper.copy_from(other, key)
+            other.close()
+
+    def test_copy_from_unknown_key_raises_key_error(self):
+        with tempfile.TemporaryDirectory() as other_root:
+            other = Keeper(FileStorage(other_root))
+            with self.assertRaises(KeyError):
+                self.keeper.copy_from(other, '2a206783b16f327a53555861331980835a0e059e')
+            other.close()
+
+    def test_default_digest_is_sha1(self):
+        self.assertEqual(self.keeper.digest, "sha1")
+        key = self.keeper.add(b'gdgdgdggd')
+        self.assertEqual(len(key), 40)
+
+    def test_alternative_digest(self):
+        keeper = Keeper(self.storage, digest="sha256")
+        key = keeper.add(b'gdgdgdggd')
+        self.assertEqual(len(key), 64)
+        self.assertEqual(keeper[key].as_bytes(), b'gdgdgdggd')
+
+    @unittest.skipUnless(importlib.util.find_spec("blake3"), "requires blake3")
+    def test_blake3_digest(self):
+        keeper = Keeper(self.storage, digest="blake3")
+        data = RANDOM_DATA[:1024 * 1024]
+        key = keeper.add(data)
+        self.assertEqual(len(key), 64)
+        self.assertEqual(keeper[key].as_bytes(), data)
+
+    def test_unknown_digest_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            Keeper(self.storage, digest="nonesuch")
+
 
 class StreamTestsOnFileStorage(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Under TMPDIR, which may be a RAM disk, rather than the working directory
+        cls.root_directory = tempfile.TemporaryDirectory(prefix='keeper-')
+        cls.root_dirpath = cls.root_directory.name
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.root_directory.cleanup()
+
     def setUp(self):
-        self.original_stream = console.stream
-        console.stream = sys.stdout
-        self.keeper_root = 'testkeeper'
-        shutil.rmtree(self.keeper_root, ignore_errors=True)
-
-        try:
-            os.mkdir(self.keeper_root)
-        except FileExistsError:
-            pass
+        # Each test has its own store within the directory shared by the class
+        self.keeper_root = os.path.join(self.root_dirpath, self._testMethodName)
         self.storage = FileStorage(self.keeper_root)
         self.keeper = Keeper(self.storage)
 
     def tearDown(self):
         self.keeper.close()
         self.storage.close()
-        try:
-            shutil.rmtree(self.keeper_root)
-        except FileNotFoundError:
-            pass
-        console.stream = self.original_stream
 
 
     def test_add_stream_in_context(self):
@@ -252,21 +437,45 @@ class StreamTestsOnFileStorage(unittest.TestCase):
         self.assertEqual(key1, key2)
         self.assertEqual(len(self.keeper), 1)
 
-    # def test_key_identical_strings_add_before_stream(self):
-    #     key1 = self.keeper.add('gdgdgdggd')
-    #     with self.keeper.add_stream(encoding=sys.getdefaultencoding()) as stream:
-    #         stream.write('gdgdgdggd')
-    #     key2 = stream.key
-    #     self.assertEqual(key1, key2)
-    #     self.assertEqual(len(self.keeper), 1)
-    #
-    # def test_key_identical_strings_stream_before_add(self):
-    #     with self.keeper.add_stream(encoding=sys.getdefaultencoding()) as stream:
-    #         stream.write('gdgdgdggd')
-    #     key1 = stream.key
-    #     key2 = self.keeper.add('gdgdgdggd')
-    #     self.assertEqual(key1, key2)
-    #     self.assertEqual(len(self.keeper), 1)
+    def test_key_identical_bytes_with_meta(self):
+        key1 = self.keeper.add(b'gdgdgdggd', mime="text/plain", colour="red")
+        with self.keeper.add_stream(mime="text/plain", colour="red") as stream:
+            stream.write(b'gdgdgdggd')
+        self.assertEqual(key1, stream.key)
+        self.assertEqual(len(self.keeper), 1)
+
+    def test_add_duplicate_bytes_leaves_no_temporaries(self):
+        self.keeper.add(b'gdgdgdggd')
+        self.keeper.add(b'gdgdgdggd')
+        self.assertEqual(os.listdir(os.path.join(self.keeper_root, 'temp')), [])
+
+    def test_key_identical_strings_add_before_stream(self):
+        key1 = self.keeper.add('gdgdgdggd')
+        with self.keeper.add_stream(encoding=DEFAULT_ENCODING) as stream:
+            stream.write('gdgdgdggd')
+        key2 = stream.key
+        self.assertEqual(key1, key2)
+        self.assertEqual(len(self.keeper), 1)
+
+    def test_key_identical_strings_stream_before_add(self):
+        with self.keeper.add_stream(encoding=DEFAULT_ENCODING) as stream:
+            stream.write('gdgdgdggd')
+        key1 = stream.key
+        key2 = self.keeper.add('gdgdgdggd')
+        self.assertEqual(key1, key2)
+        self.assertEqual(len(self.keeper), 1)
+
+    def test_stream_encodes_strings_incrementally(self):
+        with self.keeper.add_stream(encoding='utf-16') as stream:
+            stream.write('søker ')
+            stream.write('sjåfør')
+        self.assertEqual(self.keeper[stream.key].as_string(), 'søker sjåfør')
+        self.assertEqual(stream.key, self.keeper.add('søker sjåfør', encoding='utf-16'))
+
+    def test_write_string_without_encoding_raises_type_error(self):
+        with self.keeper.add_stream() as stream:
+            with self.assertRaises(TypeError):
+                stream.write('gdgdgdggd')
 
 
 # class BufferedStreamTests(unittest.TestCase):
@@ -377,243 +586,46 @@ class StreamTestsOnFileStorage(unittest.TestCase):
 #             stream.close()
 #             self.assertEqual(len(self.keeper), 1)
 
-class TestKeeperOnCachedFileStorage(unittest.TestCase):
+
+class TestKeeperOnCachedFileStorage(TestKeeperOnFileStorage):
 
     def setUp(self):
-        self.original_stream = console.stream
-        console.stream = sys.stdout
-        self.keeper_root = 'testkeeper'
-        shutil.rmtree(self.keeper_root, ignore_errors=True)
-
-        try:
-            os.mkdir(self.keeper_root)
-        except FileExistsError:
-            pass
+        self.keeper_root = os.path.join(self.root_dirpath, self._testMethodName)
         self.file_storage = FileStorage(self.keeper_root)
         self.cache_storage = WriteCacheStorage(self.file_storage)
+        self.storage = self.cache_storage
         self.keeper = Keeper(self.cache_storage)
 
     def tearDown(self):
         self.keeper.close()
         self.cache_storage.close()
         self.file_storage.close()
-        try:
-            shutil.rmtree(self.keeper_root)
-        except FileNotFoundError:
-            pass
-        console.stream = self.original_stream
-
-    def test_create(self):
-        pass
-
-    def test_len_empty(self):
-        self.assertEqual(len(self.keeper), 0)
-
-    def test_len_one(self):
-        self.keeper.add(b'hsgshsgsha')
-        self.assertEqual(len(self.keeper), 1)
-
-    def test_len_two(self):
-        self.keeper.add(b'hsgshsgsha')
-        self.keeper.add(b'fdfdsffsdf')
-        self.assertEqual(len(self.keeper), 2)
-
-    def test_len_identical(self):
-        key1 = self.keeper.add(b'gdgdgdggd')
-        key2 = self.keeper.add(b'gdgdgdggd')
-        self.assertEqual(len(self.keeper), 1)
-
-    def test_distinct_keys(self):
-        key1 = self.keeper.add(b'hsgshsgsha')
-        key2 = self.keeper.add(b'xsgshsgsha')
-        self.assertNotEqual(key1, key2)
-
-    def test_key_identical(self):
-        key1 = self.keeper.add(b'gdgdgdggd')
-        key2 = self.keeper.add(b'gdgdgdggd')
-        self.assertEqual(key1, key2)
-
-    def test_store_strings(self):
-        key1 = self.keeper.add("The quick brown fox jumped over the lazy dog")
-        pass
-
-    def test_store_unicode_strings(self):
-        key1 = self.keeper.add("Søker for kanaler")
-        pass
-
-    def test_retrieve_bytes(self):
-        string = "The hunting of the snark"
-        key1 = self.keeper.add(string)
-        value = self.keeper[key1]
-        self.assertEqual(value.as_string(), string)
-
-    def test_string_encoding(self):
-        string = "It was the best of times. It was the worst of times."
-        key1 = self.keeper.add(string)
-        value = self.keeper[key1]
-        self.assertEqual(value.meta.encoding, sys.getdefaultencoding())
-
-    def test_unknown_key(self):
-        with self.assertRaises(KeyError):
-            _ = self.keeper['hello']
-
-    def test_encoding(self):
-        data = "søker sjåfør".encode('utf-16')
-        key = self.keeper.add(data, encoding='utf-16')
-        self.assertEqual(self.keeper[key].meta.encoding, 'utf-16')
-
-    def test_add_bytes_retrieve_string(self):
-        string = "søker sjåfør"
-        data = string.encode('utf-16')
-        key = self.keeper.add(data, encoding='utf-16')
-        self.assertEqual(self.keeper[key].as_string(), string)
-
-    def test_add_string_retrieve_bytes(self):
-        string = "søker sjåfør"
-        key = self.keeper.add(string)
-        self.assertEqual(self.keeper[key].as_bytes(), string.encode())
-
-    def test_length(self):
-        data = b'The quick brown fox jumped over the lazy dog.'
-        key = self.keeper.add(data)
-        self.assertEqual(len(self.keeper[key].as_bytes()), self.keeper[key].meta.length)
 
-    def test_mime_type(self):
-        string = "<!DOCTYPE html><html><body><b>Thunderbirds are go</b></body></html>"
-        key = self.keeper.add(string, mime="text/html")
-        self.assertEqual(self.keeper[key].meta.mime, "text/html")
 
-    def test_bytes_encoding(self):
-        string = "<!DOCTYPE html><html><body><b>Thunderbirds are go</b></body></html>"
-        data = string.encode('utf-32')
-        key = self.keeper.add(data, encoding='utf-32')
-        self.assertEqual(self.keeper[key].meta.encoding, 'utf-32')
-
-    def test_meta_attributes_default(self):
-        key = self.keeper.add(b'')
-        meta = self.keeper[key].meta
-        self.assertIn('length', meta)
-        self.assertIn('mime', meta)
-        self.assertIn('encoding', meta)
-
-    def test_iterate_default_meta_attributes(self):
-        key = self.keeper.add(b'')
-        meta = self.keeper[key].meta
-        attributes = list(self.keeper[key].meta)
-        self.assertEqual(len(attributes), 3)
-        self.assertIn('length', attributes)
-        self.assertIn('mime', attributes)
-        self.assertIn('encoding', attributes)
-
-    def test_arbitrary_metadata(self):
-        text = "We'll attach some arbitrary meta data to this"
-        key = self.keeper.add(text, mime="text/plain", filename="foo.txt", author="Joe Bloggs")
-        self.assertEqual(self.keeper[key].meta.filename, "foo.txt")
-        self.assertEqual(self.keeper[key].meta.author, "Joe Bloggs")
-
-    def test_iterate_arbitrary_metadata(self):
-        text = "We'll attach some arbitrary meta data to this"
-        key = self.keeper.add(text, mime="text/plain", filename="foo.txt", author="Joe Bloggs")
-        attributes = list(self.keeper[key].meta)
-        self.assertEqual(len(attributes), 5)
-        self.assertIn('length', attributes)
-        self.assertIn('mime', attributes)
-        self.assertIn('encoding', attributes)
-        self.assertIn('filename', attributes)
-        self.assertIn('author', attributes)
-
-    def test_meta_keys_distinct(self):
-        string = "<!DOCTYPE html><html><body><b>Thunderbirds are go</b></body></html>"
-        key1 = self.keeper.add(string, mime="text/html")
-        key2 = self.keeper.add(string, mime="text/plain")
-        self.assertNotEqual(key1, key2)
-
-    def test_encodings_distinct(self):
-        key1 = self.keeper.add(b'', encoding='utf-8')
-        key2 = self.keeper.add(b'', encoding='utf-16')
-        self.assertNotEqual(key1, key2)
-
-    def test_large_data(self):
-        data = os.urandom(10 * 1024 * 1024)
-        key = self.keeper.add(data)
-        data2 = self.keeper[key].as_bytes()
-        self.assertEqual(data, data2)
-
-    def test_contains_negative(self):
-        self.assertNotIn('2a206783b16f327a53555861331980835a0e059e', self.keeper)
-
-    def test_contains_positive(self):
-        key = self.keeper.add("Some data")
-        self.assertIn(key, self.keeper)
-
-    def test_remove_item_positive(self):
-        text = "We'll attach some arbitrary meta data to this"
-        key = self.keeper.add(text, mime="text/plain", filename="foo.txt", author="Joe Bloggs")
-        self.assertIn(key, self.keeper)
-        del self.keeper[key]
-        self.assertNotIn(key, self.keeper)
-
-    def test_remove_item_negative(self):
-        with self.assertRaises(KeyError):
-            _ = self.keeper['2a206783b16f327a53555861331980835a0e059e']
-
-
-class StreamTestsOnCachedFileStorage(unittest.TestCase):
+class StreamTestsOnCachedFileStorage(StreamTestsOnFileStorage):
 
     def setUp(self):
-        self.original_stream = console.stream
-        console.stream = sys.stdout
-        self.keeper_root = 'testkeeper'
-        shutil.rmtree(self.keeper_root, ignore_errors=True)
-
-        try:
-            os.mkdir(self.keeper_root)
-        except FileExistsError:
-            pass
+        self.keeper_root = os.path.join(self.root_dirpath, self._testMethodName)
         self.file_storage = FileStorage(self.keeper_root)
         self.cache_storage = WriteCacheStorage(self.file_storage)
+        self.storage = self.cache_storage
         self.keeper = Keeper(self.cache_storage)
 
     def tearDown(self):
         self.keeper.close()
         self.cache_storage.close()
         self.file_storage.close()
-        try:
-            shutil.rmtree(self.keeper_root)
-        except FileNotFoundError:
-            pass
-        console.stream = self.original_stream
-
-    def test_add_stream_in_context(self):
-        with self.keeper.add_stream() as stream:
-            stream.write(b"The quick brown fox jumped over the lazy dog")
-        self.assertIn(stream.key, self.keeper)
 
-    def test_add_stream_with_close(self):
-        stream = self.keeper.add_stream()
-        stream.write(b"The very hungry caterpillar")
-        stream.close()
-        self.assertIn(stream.key, self.keeper)
 
-    def test_key_in_none_before_close(self):
-        stream = self.keeper.add_stream()
-        stream.write(b"The very hungry caterpillar")
-        self.assertIs(stream.key, None)
-        stream.close()
-
-    def test_key_identical_bytes_add_before_stream(self):
-        key1 = self.keeper.add(b'gdgdgdggd')
-        with self.keeper.add_stream() as stream:
-            stream.write(b'gdgdgdggd')
-        key2 = stream.key
-        self.assertEqual(key1, key2)
-        self.assertEqual(len(self.keeper), 1)
+class TestKeeperOnIndexedFileStorage(TestKeeperOnFileStorage):
 
-    def test_key_identical_bytes_stream_before_add(self):
-        with self.keeper.add_stream() as stream:
-            stream.write(b'gdgdgdggd')
-        key1 = stream.key
-        key2 = self.keeper.add(b'gdgdgdggd')
-        self.assertEqual(key1, key2)
-        self.assertEqual(len(self.keeper), 1)
+    def setUp(self):
+        super().setUp()
+        self.keeper.close()
+        self.file_storage = self.storage
+        self.storage = IndexedStorage(self.file_storage)
+        self.keeper = Keeper(self.storage)
 
+    def tearDown(self):
+        super().tearDown()
+        self.file_storage.close()
@@ -0,0 +1,36 @@
+import io
+import unittest
+
+from keeper.storage.streams import ReadOnlyStream, WriteOnlyStream
+
+
+class WriteOnlyStreamTests(unittest.TestCase):
+
+    def test_write(self):
+        raw = io.BytesIO()
+        with WriteOnlyStream(raw) as stream:
+            stream.write(b'abc')
+            stream.writelines([b'def', b'ghi'])
+        self.assertEqual(raw.getvalue(), b'abcdefghi')
+
+    def test_write_after_close_raises_value_error(self):
+        stream = WriteOnlyStream(io.BytesIO())
+        stream.close()
+        with self.assertRaises(ValueError):
+            stream.write(b'abc')
+
+
+class ReadOnlyStreamTests(unittest.TestCase):
+
+    def test_read(self):
+        with ReadOnlyStream(io.BytesIO(b'abcdef')) as stream:
+            self.assertEqual(stream.read(2), b'ab')
+            buffer = bytearray(4)
+            self.assertEqual(stream.readinto(buffer), 4)
+        self.assertEqual(buffer, b'cdef')
+
+    def test_read_after_close_raises_value_error(self):
+        stream = ReadOnlyStream(io.BytesIO(b'abc'))
+        stream.close()
+        with self.assertRaises(ValueError):
+            stream.read()
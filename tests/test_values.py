@@ -0,0 +1,55 @@
+import pickle
+import unittest
+
+from keeper.values import ValueMeta
+
+
+class ValueMetaTests(unittest.TestCase):
+
+    def test_default_attributes(self):
+        meta = ValueMeta(length=42)
+        self.assertEqual(meta.length, 42)
+        self.assertIsNone(meta.mime)
+        self.assertIsNone(meta.encoding)
+
+    def test_arbitrary_attribute(self):
+        meta = ValueMeta(length=42, author="Joe Bloggs")
+        self.assertEqual(meta.author, "Joe Bloggs")
+
+    def test_unknown_attribute_raises_attribute_error(self):
+        meta = ValueMeta(length=42)
+        with self.assertRaises(AttributeError):
+            _ = meta.author
+
+    def test_serialise_round_trip(self):
+        meta = ValueMeta(length=42, mime="text/plain", encoding="utf-8", author="Joe Bloggs")
+        self.assertEqual(ValueMeta.deserialise(meta.serialise()).to_dict(), meta.to_dict())
+
+    def test_serialise_round_trip_without_optional_fields(self):
+        meta = ValueMeta(length=0)
+        self.assertEqual(ValueMeta.deserialise(meta.serialise()).to_dict(), meta.to_dict())
+
+    def test_serialise_round_trip_empty_strings(self):
+        meta = ValueMeta(length=7, mime="", encoding="")
+        self.assertEqual(ValueMeta.deserialise(meta.serialise()).to_dict(), meta.to_dict())
+
+    def test_serialise_non_string_mime_round_trip(self):
+        meta = ValueMeta(length=42, mime=('text', 'plain'))
+        self.assertEqual(ValueMeta.deserialise(meta.serialise()).to_dict(), meta.to_dict())
+
+    def test_pickle_round_trip(self):
+        meta = ValueMeta(length=42, mime="text/plain", tags=('a', 'b'))
+        self.assertEqual(pickle.loads(pickle.dumps(meta)).to_dict(), meta.to_dict())
+
+    def test_deserialise_legacy_pickle(self):
+        # As written to meta files by keeper 1.1.1
+        legacy = (
+            b'\x80\x04\x95r\x00\x00\x00\x00\x00\x00\x00\x8c\rkeeper.values\x94\x8c\tValueMeta'
+            b'\x94\x93\x94)\x81\x94}\x94\x8c\t_keywords\x94}\x94(\x8c\x06length\x94K*\x8c\x04mime'
+            b'\x94N\x8c\x08encoding\x94\x8c\x05utf-8\x94\x8c\x06author\x94\x8c\nJoe Bloggs\x94usb.'
+        )
+        meta = ValueMeta.deserialise(legacy)
+        self.assertEqual(meta.length, 42)
+        self.assertIsNone(meta.mime)
+        self.assertEqual(meta.encoding, 'utf-8')
+        self.assertEqual(meta.author, 'Joe Bloggs')
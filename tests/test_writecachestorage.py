@@ -1,34 +1,76 @@
+import threading
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from keeper.storage.writecachestorage import WriteCacheStorage
 
 
 class TestWriteCacheStorage(unittest.TestCase):
 
+    def setUp(self):
+        self.storage = Mock(closed=False)
+        self.f = WriteCacheStorage(self.storage)
+
+    def tearDown(self):
+        if not self.f.closed:
+            self.f.close()
+
     def test_constructing_with_closed_underlying_storage_raises_value_error(self):
         storage = Mock(closed=True)
         with self.assertRaises(ValueError):
            WriteCacheStorage(storage)
 
     def test_closing_does_not_close_underlying_storage(self):
-        storage = Mock(closed=False)
-        f = WriteCacheStorage(storage)
-        f.close()
-        storage.close.assert_not_called()
+        self.f.close()
+        self.storage.close.assert_not_called()
 
     def test_is_not_closed_after_construction(self):
-        storage = Mock(closed=False)
-        f = WriteCacheStorage(storage)
-        self.assertFalse(f.closed)
+        self.assertFalse(self.f.closed)
 
     def test_is_closed_after_closing(self):
-        storage = Mock(closed=False)
-        f = WriteCacheStorage(storage)
-        f.close()
-        self.assertTrue(f.closed)
+        self.f.close()
+        self.assertTrue(self.f.closed)
 
     def test_storage_property_returns_storage_parameter(self):
-        storage = Mock(closed=False)
-        f = WriteCacheStorage(storage)
-        self.assertIs(f.storage, storage)
+        self.assertIs(self.f.storage, self.storage)
+
+    def test_max_workers_limits_executor(self):
+        f = WriteCacheStorage(self.storage, max_workers=2)
+        self.assertEqual(f._executor._max_workers, 2)
+        f.close()
+
+    def test_promoted_temp_is_readable_before_it_is_written(self):
+        written = threading.Event()
+        self.storage.write_data.side_effect = lambda key, data: written.wait(5)
+        with self.f.openout_temp() as temp:
+            temp.write(b'Some data')
+        self.f.promote_temp(temp.name, 'key')
+        with self.f.openin_data('key') as data_file:
+            self.assertEqual(data_file.read(), b'Some data')
+        written.set()
+        self.f.close()
+        self.storage.write_data.assert_called_once_with('key', b'Some data')
+
+    def test_data_written_in_chunks_is_joined(self):
+        with self.f.openout_data('key') as data_file:
+            data_file.write(b'Some ')
+            data_file.write(bytearray(b'more '))
+            data_file.writelines([memoryview(b'data')])
+        self.f.close()
+        self.storage.write_data.assert_called_once_with('key', b'Some more data')
+
+    def test_data_discarded_before_it_is_written_is_not_written(self):
+        # A single worker, held up by the first write, so the second is still queued
+        f = WriteCacheStorage(self.storage, max_workers=1)
+        written = threading.Event()
+        self.storage.write_data.side_effect = lambda key, data: written.wait(5)
+        futures = []
+        submit = f._executor.submit
+        with patch.object(f._executor, 'submit', lambda *args: futures.append(submit(*args))):
+            f.write_data('first', b'Some data')
+            f.write_data('key', b'More data')
+            f.discard('key')
+        written.set()
+        f.close()
+        self.storage.write_data.assert_called_once_with('first', b'Some data')
+        self.assertEqual([future.exception() for future in futures], [None, None])